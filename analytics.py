@@ -0,0 +1,184 @@
+import config
+import csv
+from datetime import datetime
+import excel
+import itertools
+import metrics
+import os
+import shutil
+import threading
+import time
+
+# Optional, only needed for analytics_formats "parquet".  Imported by formats() as it is slow to load.
+pyarrow = None
+
+# Load settings file
+settings = config.load()
+
+# Folder inside each process's export folder that holds the analytics datasets
+ANALYTICS_FOLDER = "_analytics"
+
+# Columns added in front of the definition's columns, so rows can be matched back to their form
+KEY_COLUMNS = (("FormID", "int"), ("Started", "date"))
+
+# Date formats tried for "date" columns, Cube's own format first
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+
+# Rows waiting to be written, keyed by (output_dir, name, year, month).  Each entry is an
+# excel.SheetBatch with the column types seen so far.
+_batches = {}
+_pending = {}  # Rows waiting per output_dir
+_keys = {}  # Rows waiting per FormID
+_lock = threading.Lock()
+
+# Part files are named after the run, so runs never overwrite each other's files
+_run = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+_sequence = itertools.count(1)
+
+# Function to return the analytics formats turned on in config.json ("parquet" and/or "csv")
+def formats():
+    global pyarrow
+
+    value = settings.get('analytics_formats') or []
+    if isinstance(value, str):
+        value = [value]
+    for name in value:
+        if name not in ('parquet', 'csv'):
+            raise ValueError(f"Unknown analytics format \"{name}\" (use \"parquet\" or \"csv\")")
+    if 'parquet' in value and pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("analytics_formats \"parquet\" requires the pyarrow library (pip install pyarrow)")
+    return value
+
+# Function to check if the analytics export is turned on in config.json
+def enabled():
+    return bool(formats())
+
+# Function to convert a value to its column's declared type.  Values that are empty or can't be
+# converted become nulls, except in "string" columns where "" is kept as Process.xlsx does.
+def convert(value, column_type):
+    if column_type == "string":
+        if value is None or isinstance(value, str):
+            return value
+        return str(value)
+
+    if value is None or value == "":
+        return None
+    try:
+        if column_type == "int":
+            return int(value)
+        if column_type == "float":
+            return float(value)
+        if column_type == "bool":
+            if isinstance(value, bool):
+                return value
+            return {"true": True, "yes": True, "1": True, "false": False, "no": False, "0": False}.get(str(value).lower())
+        if column_type == "date":
+            if isinstance(value, datetime):
+                return value
+            for date_format in DATE_FORMATS:
+                try:
+                    return datetime.strptime(value, date_format)
+                except ValueError:
+                    pass
+            return None
+    except (TypeError, ValueError):
+        return None
+    return value
+
+def _arrow_type(column_type):
+    return {
+        "string": pyarrow.string(),
+        "int": pyarrow.int64(),
+        "float": pyarrow.float64(),
+        "bool": pyarrow.bool_(),
+        "date": pyarrow.timestamp('s'),
+    }[column_type]
+
+# Function to queue a form's row for a process's analytics dataset.  name is "toc" or "report",
+# columns is the definition's plan from excel.compile_columns and values its excel.row().
+# Returns the number of rows waiting for output_dir.
+def add(output_dir, name, columns, values, form_id, started):
+    header = excel.header(columns)
+    key_values = {"FormID": form_id, "Started": started}
+    keys = [(column, column_type) for column, column_type in KEY_COLUMNS if column not in header]
+
+    header = tuple(column for column, _ in keys) + header
+    types = tuple(column_type for _, column_type in keys) + excel.column_types(columns)
+    values = tuple(key_values[column] for column, _ in keys) + tuple(values)
+    row = tuple(convert(value, column_type) for value, column_type in zip(values, types))
+
+    with _lock:
+        key = (output_dir, name, started.year, started.month)
+        batch, column_types = _batches.setdefault(key, (excel.SheetBatch(), {}))
+        batch.add(header, [row], form_id)
+        column_types.update(zip(header, types))
+        _keys[form_id] = _keys.get(form_id, 0) + 1
+        _pending[output_dir] = _pending.get(output_dir, 0) + 1
+        return _pending[output_dir]
+
+# Function to check if rows queued for a FormID are still waiting to be written
+def is_buffered(form_id):
+    with _lock:
+        return form_id in _keys
+
+# Function to return the FormIDs with rows still waiting to be written
+def buffered_keys():
+    with _lock:
+        return set(_keys)
+
+# Function to stop tracking written or dropped rows.  Called with _lock held.
+def _release(form_ids):
+    for form_id in form_ids:
+        _keys[form_id] -= 1
+        if not _keys[form_id]:
+            del _keys[form_id]
+
+# Function to write the waiting rows of a process export folder (all folders if output_dir is None).
+# Each partition (year and month the form was started) gets a new part file per format, so files
+# are only ever added and memory is bounded by analytics_batch.
+def flush(output_dir=None):
+    with _lock:
+        keys = [key for key in _batches if output_dir is None or key[0] == output_dir]
+        pending = {key: _batches.pop(key) for key in keys}
+        for directory in {key[0] for key in keys}:
+            _pending.pop(directory, None)
+
+    for (directory, name, year, month), (batch, column_types) in pending.items():
+        part = f"part-{_run}-{next(_sequence):05d}"
+
+        with metrics.timer("analytics_write"):
+            for file_format in formats():
+                # eg. _analytics/parquet/report/year=2024/month=09/part-....parquet
+                folder = os.path.join(directory, ANALYTICS_FOLDER, file_format, name, f"year={year}", f"month={month:02d}")
+                os.makedirs(folder, exist_ok=True)
+
+                # Write under a hidden name first so readers never see a half-written file
+                path = os.path.join(folder, f"{part}.{file_format}")
+                temp_path = os.path.join(folder, f".{part}.{file_format}.tmp")
+                if file_format == 'parquet':
+                    schema = pyarrow.schema([(column, _arrow_type(column_types[column])) for column in batch.header])
+                    pyarrow.parquet.write_table(batch.arrow(schema), temp_path)
+                else:
+                    with open(temp_path, 'w', newline='', encoding='utf-8') as csv_file:
+                        writer = csv.writer(csv_file)
+                        writer.writerow(batch.header)
+                        writer.writerows(batch.rows())
+                os.replace(temp_path, path)
+
+    with _lock:
+        for batch, _ in pending.values():
+            _release(batch.keys)
+
+# Function to drop a process's analytics dataset and its waiting rows, for when every form of the
+# process is exported again
+def reset(output_dir):
+    with _lock:
+        for key in [key for key in _batches if key[0] == output_dir]:
+            batch, _ = _batches.pop(key)
+            _release(batch.keys)
+        _pending.pop(output_dir, None)
+    shutil.rmtree(os.path.join(output_dir, ANALYTICS_FOLDER), ignore_errors=True)
@@ -1,60 +1,274 @@
 import config
+import database
+from datetime import datetime, timezone
+import hashlib
+import metrics
 import requests
+from requests.adapters import HTTPAdapter
 import sys
+import threading
+import time
 
 #Load settings file
 settings = config.load()
-headers = "{'RpmApiKey': settings['cube_api'], 'Content-Type': 'application/json'}"
+
+# Shared HTTP sessions, created on first use
+_session = None
+_download_session = None
+_session_lock = threading.Lock()
+
+# Message Cube returns once the daily API allowance is used up
+LIMIT_MESSAGE = "API daily limit reached"
+
+# Raised when an attachment's download URL can't be fetched because the daily budget is used up.
+# The form is left unfinished so its attachments are fetched on a later run.
+class LimitReached(Exception):
+    pass
+
+# Daily quota and rate limiter state
+_quota_lock = threading.Lock()
+_quota_day = None
+_quota_used = 0
+_quota_unsaved = 0
+_quota_cnx = None
+_tokens = None
+_token_time = None
 
 def headers():
     global settings
-    
+
     return {
         'RpmApiKey': settings['cube_api'],
         'Content-Type': 'application/json'
     }
 
+# Function to build a keep-alive session with a connection pool for every thread that can use it
+# at once: the export threads plus the attachment_workers pool, which fetches download URLs and files
+def _build_session(session_headers=None):
+    pool_size = settings.get('max_workers', 12) + settings.get('attachment_workers', 8)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+    http = requests.Session()
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    if session_headers:
+        http.headers.update(session_headers)
+    return http
+
+# Function to return the shared Cube API session (headers are set once on the session)
+def session():
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session(headers())
+    return _session
+
+# Function to return the shared session used for attachment downloads (no API key is sent)
+def download_session():
+    global _download_session
+
+    if _download_session is None:
+        with _session_lock:
+            if _download_session is None:
+                _download_session = _build_session()
+    return _download_session
+
+# Function to return a short ID for the API key, so each key's budget is counted separately
+# without storing the key itself
+def key_id():
+    return hashlib.sha256(settings['cube_api'].encode()).hexdigest()[:16]
+
+# Function to return the current UTC day (Cube's quota resets daily)
+def _today():
+    return datetime.now(timezone.utc).date()
+
+# Function to load today's API call count from the database
+def quota_load(cursor):
+    global _quota_day, _quota_used, _quota_unsaved
+
+    with _quota_lock:
+        _quota_day = _today()
+        _quota_used = database.api_usage_fetch(cursor, _quota_day, key_id())
+        _quota_unsaved = 0
+
+# Function to write unsaved API call counts to the database
+def quota_save():
+    with _quota_lock:
+        _quota_save()
+
+def _quota_save():
+    global _quota_cnx, _quota_unsaved
+
+    if not _quota_unsaved or _quota_day is None:
+        return
+    try:
+        if _quota_cnx is None:
+            _quota_cnx = database.setup()
+        cursor = _quota_cnx.cursor()
+        database.api_usage_add(cursor, _quota_day, key_id(), _quota_unsaved, _quota_cnx)
+        cursor.close()
+        _quota_unsaved = 0
+    except Exception as e:
+        print(f"Error saving API usage to SQL: {e}")
+
+# Function to roll the quota over when the UTC day changes
+def _quota_rollover():
+    global _quota_day, _quota_used
+
+    today = _today()
+    if _quota_day != today:
+        _quota_save()
+        _quota_day = today
+        _quota_used = 0
+
+# Function to return how many API calls are left today
+def quota_remaining():
+    with _quota_lock:
+        _quota_rollover()
+        return max(settings.get('api_daily_limit', 40000) - _quota_used, 0)
+
+# Function to check whether there is enough budget left to start another form.
+# api_quota_reserve calls are held back for attachment lookups of forms already in progress.
+def quota_available():
+    return quota_remaining() > settings.get('api_quota_reserve', 200)
+
+# Function to record that Cube has reported the daily limit, so no further calls are made today
+def quota_exhausted():
+    global _quota_used, _quota_unsaved
+
+    with _quota_lock:
+        _quota_rollover()
+        remaining = settings.get('api_daily_limit', 40000) - _quota_used
+        if remaining > 0:
+            _quota_used += remaining
+            _quota_unsaved += remaining
+        _quota_save()
+
+# Function to count one API call against today's budget and take a token from the rate limiter.
+# Returns the number of seconds the caller must wait before making the call, or None if the
+# daily budget is used up.
+def quota_take():
+    global _quota_used, _quota_unsaved, _tokens, _token_time
+
+    with _quota_lock:
+        _quota_rollover()
+        if _quota_used >= settings.get('api_daily_limit', 40000):
+            return None
+
+        _quota_used += 1
+        _quota_unsaved += 1
+        if _quota_unsaved >= settings.get('api_quota_flush', 25):
+            _quota_save()
+
+        # Token bucket, refilled at api_calls_per_second (0 disables rate limiting)
+        rate = settings.get('api_calls_per_second', 0)
+        if not rate:
+            return 0
+
+        now = time.monotonic()
+        if _tokens is None:
+            _tokens, _token_time = rate, now
+        _tokens = min(rate, _tokens + (now - _token_time) * rate)
+        _token_time = now
+        _tokens -= 1
+        return -_tokens / rate if _tokens < 0 else 0
+
+# Function to block until an API call may be made.  Returns False if the daily budget is used up
+def quota_acquire():
+    delay = quota_take()
+    if delay is None:
+        return False
+    if delay:
+        time.sleep(delay)
+    return True
+
+# Response returned in place of a Cube call once the local budget is used up
+def limit_response():
+    return {"Result": {"Error": {"Message": LIMIT_MESSAGE}}}
+
+# Function to close the shared sessions and their connection pools
+def close():
+    global _session, _download_session, _quota_cnx
+
+    quota_save()
+    with _quota_lock:
+        if _quota_cnx is not None:
+            _quota_cnx.close()
+            _quota_cnx = None
+
+    with _session_lock:
+        for http in (_session, _download_session):
+            if http is not None:
+                http.close()
+        _session = None
+        _download_session = None
+
+# Function to POST to a Cube endpoint, recording the call's latency and count per endpoint
+def _post(url, payload):
+    endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+    metrics.count(f"api_calls.{endpoint}")
+    with metrics.timer(f"api.{endpoint}"):
+        return session().post(url, json=payload)
+
 # Function to fetch data from API
-def fetch_data(url, data=None):   
+def fetch_data(url, data=None):
+    if not quota_acquire():
+        return limit_response()
+
     try:
-        api_headers = headers()  # Call the headers function to get the dictionary
-        response = requests.post(url, headers=api_headers, json=data)
-        
+        response = _post(url, data)
+
         response.raise_for_status()  # Raises an error for bad status codes
     except:
         print ("Error fetching data from Cube API...")
         sys.exit(1)
-        
+
     return response.json()
 
 # Function to fetch data from API
 def fetch_form(form_id):
+    if not quota_acquire():
+        return limit_response()
+
     try:
         payload = {
             "FormID": form_id
         }
-        response = requests.post(settings['api_urls']['data'], headers=headers(), json=payload)
+        response = _post(settings['api_urls']['data'], payload)
         response.raise_for_status()
-        
+
     except:
         print(response)
         print (f"Error fetching form {form_id}")
         return None
         sys.exit(1)
-        
+
     return response.json()
 
-# Function to fetch file download URL from API
+# Function to fetch file download URL from API.  Raises LimitReached if the daily budget is used up
 def fetch_file_url(file_id):
+    if not quota_acquire():
+        raise LimitReached(LIMIT_MESSAGE)
+
     payload = {
         "FileID": file_id,
         "ReturnDownloadUrl": True
     }
-    response = requests.post(settings['api_urls']['files'], headers=headers(), json=payload)
-    
-    return response.json()["Result"]["DownloadUrl"]
+    response = _post(settings['api_urls']['files'], payload)
+
+    return file_url(response.json())
+
+# Function to return the download URL from a ProcFormFile response.  Raises LimitReached if Cube
+# reports the daily limit.
+def file_url(data):
+    if data.get("Result", {}).get("Error", {}).get("Message") == LIMIT_MESSAGE:
+        quota_exhausted()  # Don't spend any more calls today
+        raise LimitReached(LIMIT_MESSAGE)
+    return data["Result"]["DownloadUrl"]
 
 def endpoints():
     global settings
-    
+
     return settings['api_urls']
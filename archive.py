@@ -0,0 +1,195 @@
+import config
+import gzip
+import json
+import os
+import re
+import threading
+
+try:
+    import orjson  # Optional, much faster than the json module
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard  # Optional, only needed for archive_compression "zstd"
+except ImportError:
+    zstandard = None
+
+# Load settings file
+settings = config.load()
+
+# Folder inside each process's export folder that holds its archives
+ARCHIVE_FOLDER = "_archive"
+
+# Open archive and index files keyed by path, and a lock per archive so records don't interleave
+_files = {}
+_locks = {}
+_files_lock = threading.Lock()
+
+# Function to serialise a response.  indent=True gives the readable layout used for per-form files.
+def dumps(data, indent=False):
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(data, indent=4).encode()
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
+
+# Function to parse a serialised response
+def loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+# Function to check if archive mode is turned on in config.json
+def enabled():
+    return bool(settings.get('json_archive'))
+
+# Function to return the compression used for archives ("gzip" or "zstd") and its file extension
+def compression():
+    method = settings.get('archive_compression', 'gzip')
+    if method == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("archive_compression \"zstd\" requires the zstandard library (pip install zstandard)")
+        return method, '.jsonl.zst'
+    return 'gzip', '.jsonl.gz'
+
+def _compress(payload, method):
+    if method == 'zstd':
+        return zstandard.ZstdCompressor(level=settings.get('archive_level', 3)).compress(payload)
+    return gzip.compress(payload, compresslevel=settings.get('archive_level', 6))
+
+def _decompress(blob, path):
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f"Reading {path} requires the zstandard library (pip install zstandard)")
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return gzip.decompress(blob)
+
+# Function to return the archive path for a process export folder and month (eg. _archive/2024-09.jsonl.gz)
+def archive_path(output_dir, started):
+    _, extension = compression()
+    return os.path.join(output_dir, ARCHIVE_FOLDER, f"{started.year}-{started.month:02d}{extension}")
+
+# Function to return the index path of an archive.  The index has one JSON line per record.
+def index_path(path):
+    return path + '.index'
+
+def _open(path):
+    with _files_lock:
+        if path not in _files:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _files[path] = (open(path, 'ab'), open(index_path(path), 'a'))
+            _locks[path] = threading.Lock()
+        return _files[path], _locks[path]
+
+# Function to append a response (or its serialise() payload) to its process's archive for the
+# month the form was started.  Each record is compressed on its own (archives are a series of gzip members or zstd frames, which
+# standard tools read as one stream), so a single form can be read back without the rest of the file.
+# Returns the record's locator ("<archive path>:<offset>:<length>"), which load() reads.
+def append(output_dir, started, form_id, form_number, data):
+    method, _ = compression()
+    path = archive_path(output_dir, started)
+    payload = data if isinstance(data, bytes) else dumps(data)
+    blob = _compress(payload + b'\n', method)
+
+    (archive_file, index_file), lock = _open(path)
+    with lock:
+        offset = archive_file.seek(0, os.SEEK_END)
+        archive_file.write(blob)
+        archive_file.flush()
+
+        # The index is written after the record, so an entry always points at a complete record
+        entry = {"FormID": form_id, "Number": form_number, "Offset": offset, "Length": len(blob)}
+        index_file.write(json.dumps(entry) + '\n')
+        index_file.flush()
+
+    return f"{path}:{offset}:{len(blob)}"
+
+# Function to serialise a response the way save() writes it: one compact line for archives,
+# indented for per-form files
+def serialise(data):
+    if enabled():
+        return dumps(data)
+    return dumps(data, indent=True)
+
+# Function to save a response the way config.json asks for: appended to the archive, or as
+# <form number>.json in the form's folder.  payload is the response already passed through
+# serialise() (eg. by a render process).  Returns where it was saved, for load().
+def save(data, output_dir, form_dir, form_id, form_number, started, payload=None):
+    if payload is None:
+        payload = serialise(data)
+
+    if enabled():
+        return append(output_dir, started, form_id, form_number, payload)
+
+    os.makedirs(form_dir, exist_ok=True)
+    json_filename = os.path.normpath(os.path.join(form_dir, f"{form_number}.json"))
+    with open(json_filename, 'wb') as json_file:
+        json_file.write(payload)
+    return json_filename
+
+# Function to load a saved response from a locator returned by append() or a per-form JSON path.
+# Returns None if it no longer exists.
+def load(location):
+    if os.path.exists(location):
+        with open(location, 'rb') as json_file:
+            return loads(json_file.read())
+
+    match = re.match(r'^(.*):(\d+):(\d+)$', location)
+    if match is None or not os.path.exists(match.group(1)):
+        return None
+    path, offset, length = match.groups()
+    with open(path, 'rb') as archive_file:
+        archive_file.seek(int(offset))
+        return loads(_decompress(archive_file.read(int(length)), path))
+
+# Function to return the form number and locator of the latest record of every form archived
+# for a process export folder, keyed by FormID
+def index(output_dir):
+    folder = os.path.join(output_dir, ARCHIVE_FOLDER)
+    if not os.path.isdir(folder):
+        return {}
+
+    locators = {}
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name[:-len('.index')])
+        if not name.endswith('.index') or not os.path.exists(path):
+            continue
+        with open(index_path(path), 'r') as index_file:
+            for line in index_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Entry cut short by a crash
+                locators[entry["FormID"]] = (entry["Number"], f"{path}:{entry['Offset']}:{entry['Length']}")
+    return locators
+
+# Generator yielding (FormID, response) for every form archived for a process export folder
+def read_all(output_dir):
+    for form_id, (_, locator) in index(output_dir).items():
+        yield form_id, load(locator)
+
+# Function to return where every response saved for a process export folder can be loaded from:
+# archive records, then "<form number>/<form number>.json" files of forms that aren't archived
+def saved(output_dir):
+    entries = index(output_dir)
+    archived = {number for number, _ in entries.values()}
+    locations = [locator for _, locator in entries.values()]
+
+    if os.path.isdir(output_dir):
+        for entry in os.scandir(output_dir):
+            json_filename = os.path.join(entry.path, f"{entry.name}.json")
+            if entry.is_dir() and entry.name not in archived and os.path.isfile(json_filename):
+                locations.append(json_filename)
+    return locations
+
+# Function to close the open archives of a process export folder (all archives if output_dir is None),
+# so a run over many processes doesn't keep two files open for every process and month
+def close(output_dir=None):
+    folder = None if output_dir is None else os.path.join(output_dir, ARCHIVE_FOLDER)
+    with _files_lock:
+        for path in [path for path in _files if folder is None or os.path.dirname(path) == folder]:
+            archive_file, index_file = _files.pop(path)
+            with _locks.pop(path):
+                archive_file.close()
+                index_file.close()
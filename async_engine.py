@@ -0,0 +1,153 @@
+import api
+import asyncio
+import attachments
+import config
+import metrics
+import os
+import time
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Load settings file
+settings = config.load()
+
+# Clients shared by every coroutine while run() is active
+_api_client = None
+_download_client = None
+
+# Function to check that the optional httpx dependency is installed
+def available():
+    return httpx is not None
+
+# Function to wait for the API rate limiter.  Returns False if the daily budget is used up
+async def quota_acquire():
+    delay = api.quota_take()
+    if delay is None:
+        return False
+    if delay:
+        await asyncio.sleep(delay)
+    return True
+
+# Function to POST to a Cube endpoint, recording the call's latency and count per endpoint
+async def _post(url, payload):
+    endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+    metrics.count(f"api_calls.{endpoint}")
+    with metrics.timer(f"api.{endpoint}"):
+        return await _api_client.post(url, json=payload)
+
+# Function to fetch form data from API
+async def fetch_form(form_id):
+    if not await quota_acquire():
+        return api.limit_response()
+
+    response = await _post(settings['api_urls']['data'], {"FormID": form_id})
+    response.raise_for_status()
+    return response.json()
+
+# Function to fetch file download URL from API.  Raises api.LimitReached if the daily budget is used up
+async def fetch_file_url(file_id):
+    if not await quota_acquire():
+        raise api.LimitReached(api.LIMIT_MESSAGE)
+
+    payload = {
+        "FileID": file_id,
+        "ReturnDownloadUrl": True
+    }
+    response = await _post(settings['api_urls']['files'], payload)
+    return api.file_url(response.json())
+
+# Function to stream an attachment to a .part file and rename it once complete.  An existing
+# .part file is resumed with a Range request, as attachments.download does.
+# Returns the file path, or 0 if the download failed.
+async def download_file(url, dest_folder, file_name):
+    if url is None:
+        return 0
+
+    file_path = attachments.file_path(dest_folder, file_name)
+    part_path = file_path + '.part'
+
+    try:
+        start = time.perf_counter()
+        async with _download_client.stream('GET', url, headers=attachments.resume_headers(part_path)) as response:
+            mode = attachments.part_mode(response.status_code)
+            if mode is None:
+                return 0
+            with open(part_path, mode) as file:
+                async for chunk in response.aiter_bytes(attachments.CHUNK_SIZE):
+                    file.write(chunk)
+                    metrics.count("bytes_downloaded", len(chunk))
+
+        os.replace(part_path, file_path)
+        metrics.observe("download", time.perf_counter() - start)
+        metrics.count("files_downloaded")
+        return file_path
+    except Exception as e:
+        # Fail just this attachment, not the whole form
+        print()
+        print(f"    WARNING: Unable to download file: {file_path} ({e})")
+        print()
+        return 0
+
+# Function to save one attachment of a form, skipping the API call if it is already on disk
+async def fetch_attachment(file, dest_folder):
+    file_path = attachments.file_path(dest_folder, file["FileName"])
+    if attachments.is_complete(file_path, file):
+        return file_path
+
+    # The blob store keeps its index in SQL, so it runs on a thread
+    if attachments.blob_store_enabled():
+        return await asyncio.get_running_loop().run_in_executor(None, attachments.fetch, file, dest_folder)
+
+    file_url = await fetch_file_url(file["FileID"])
+    return await download_file(file_url, dest_folder, file["FileName"])
+
+# Function to run handler(form_id) for every form on an event loop, keeping at most
+# max_in_flight forms active.  on_done(form_id, result) is called as each form finishes
+# and no new forms are started once should_stop() returns True.
+def run(form_ids, handler, on_done, should_stop, max_in_flight):
+    return asyncio.run(_run(form_ids, handler, on_done, should_stop, max_in_flight))
+
+async def _run(form_ids, handler, on_done, should_stop, max_in_flight):
+    global _api_client, _download_client
+
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+    timeout = httpx.Timeout(settings.get('async_timeout', 300))
+
+    async with httpx.AsyncClient(headers=api.headers(), limits=limits, timeout=timeout) as api_client, \
+               httpx.AsyncClient(limits=limits, timeout=timeout, follow_redirects=True) as download_client:
+        _api_client = api_client
+        _download_client = download_client
+
+        pending = {}
+        try:
+            for form_id in form_ids:
+                if should_stop():
+                    break
+
+                pending[asyncio.ensure_future(handler(form_id))] = form_id
+
+                # Wait for a slot once the in-flight window is full
+                if len(pending) >= max_in_flight:
+                    await _drain(pending, on_done, asyncio.FIRST_COMPLETED)
+
+            if pending:
+                await _drain(pending, on_done, asyncio.ALL_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+            _api_client = None
+            _download_client = None
+
+async def _drain(pending, on_done, return_when):
+    done, _ = await asyncio.wait(list(pending), return_when=return_when)
+    for task in done:
+        form_id = pending.pop(task)
+        try:
+            result = task.result()
+        except Exception as exc:
+            print(f'\n        Form {form_id} generated an exception: {exc}')
+            result = False
+        on_done(form_id, result)
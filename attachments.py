@@ -0,0 +1,221 @@
+import api
+import config
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import database
+import hashlib
+import metrics
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+# Load settings file
+settings = config.load()
+
+# Size of the pieces attachments are streamed to disk in
+CHUNK_SIZE = 1024 * 1024
+
+# Shared pool for downloading a form's attachments in parallel, created on first use
+_executor = None
+_executor_lock = threading.Lock()
+
+# Locks held while a FileID is looked up and downloaded into the blob store, as [lock, users]
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+# Function to return the local path of an attachment with invalid characters removed
+def file_path(dest_folder, file_name):
+    valid_file_name = re.sub(r'[<>:"/\\|?*]', '', file_name)
+    return os.path.join(dest_folder, valid_file_name)
+
+# Function to check if an attachment is already on disk with the size Cube reports.
+# Cube gives Size in kilobytes with four decimals, so allow for rounding and either KB convention.
+def is_complete(path, file):
+    if not os.path.isfile(path):
+        return False
+
+    size = os.path.getsize(path)
+    if "Size" not in file:
+        return size > 0
+    return any(abs(size - file["Size"] * unit) <= 1024 for unit in (1024, 1000))
+
+# Function to return the request headers that resume the .part file an earlier download left behind
+def resume_headers(part_path):
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return {'Range': f'bytes={offset}-'} if offset else {}
+
+# Function to return the mode to open the .part file with for a download's response status,
+# or None if the download failed
+def part_mode(status_code):
+    if status_code == 206:
+        return 'ab'  # Server is resuming the partial download
+    if status_code == 200:
+        return 'wb'  # Full body, start again
+    return None
+
+# Function to stream a file to disk.  The body is written to a .part file and renamed once
+# complete, and an existing .part file is resumed with a Range request.
+# Returns the file path, or 0 if the download failed.
+def download(url, dest_folder, file_name):
+    path = file_path(dest_folder, file_name)
+    part_path = path + '.part'
+
+    try:
+        start = time.perf_counter()
+        with api.download_session().get(url, headers=resume_headers(part_path), stream=True) as response:
+            mode = part_mode(response.status_code)
+            if mode is None:
+                return 0
+
+            with open(part_path, mode) as file:
+                _write_body(response, file)
+
+        os.replace(part_path, path)
+        metrics.observe("download", time.perf_counter() - start)
+        metrics.count("files_downloaded")
+        return path
+    except Exception as e:
+        print()
+        print(f"    WARNING: Unable to download file: {path} ({e})")
+        print()
+        return 0
+
+# Function to stream a file to a new temporary file in folder.  Each call gets its own file (and
+# there is no resume), so downloads running at the same time never write to the same file.
+# Returns the temporary file's path, or 0 if the download failed.
+def download_temp(url, folder):
+    handle, temp_path = tempfile.mkstemp(suffix='.part', dir=folder)
+    try:
+        start = time.perf_counter()
+        with os.fdopen(handle, 'wb') as file:
+            with api.download_session().get(url, stream=True) as response:
+                if response.status_code != 200:
+                    raise ValueError(f"HTTP {response.status_code}")
+                _write_body(response, file)
+        os.chmod(temp_path, 0o644)  # mkstemp creates files readable by the owner only
+
+        metrics.observe("download", time.perf_counter() - start)
+        metrics.count("files_downloaded")
+        return temp_path
+    except Exception as e:
+        print()
+        print(f"    WARNING: Unable to download file: {url} ({e})")
+        print()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return 0
+
+# Function to write a streamed response body to an open file, counting the bytes downloaded
+def _write_body(response, file):
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        file.write(chunk)
+        metrics.count("bytes_downloaded", len(chunk))
+
+# Context manager held while a FileID is looked up and saved to the blob store, so forms sharing
+# an attachment (eg. a logo or SOP) download it once and the others link the stored copy
+@contextmanager
+def _file_lock(file_id):
+    with _file_locks_lock:
+        entry = _file_locks.setdefault(file_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with metrics.locked(entry[0], "blob"):
+            yield
+    finally:
+        with _file_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _file_locks[file_id]
+
+# Function to check if the content-addressed blob store is turned on in config.json
+def blob_store_enabled():
+    return bool(settings.get('blob_store'))
+
+# Function to return the blob store path of a content hash (eg. store/ab/cd/abcd...)
+def blob_path(file_hash):
+    return os.path.join(settings['blob_store'], file_hash[:2], file_hash[2:4], file_hash)
+
+# Function to return the SHA-256 of a file
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Function to place a blob in a form folder as a hardlink, or a copy where links aren't supported
+def link(source, path):
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copy2(source, path)
+    return path
+
+# Function to save an attachment through the blob store.  FileIDs already in the store are linked
+# without an API call or download.  New files are downloaded once, stored under their content hash
+# (so identical files attached under different FileIDs share one blob) and linked into the form folder.
+def fetch_blob(file, path):
+    cnx, cursor = database.thread_setup()
+
+    with _file_lock(file["FileID"]):
+        file_hash = database.file_hash(cursor, file["FileID"])
+        if file_hash and os.path.exists(blob_path(file_hash)):
+            metrics.count("files_deduplicated")
+            return link(blob_path(file_hash), path)
+
+        file_url = api.fetch_file_url(file["FileID"])
+        if not file_url:
+            return 0
+
+        temp_folder = os.path.join(settings['blob_store'], 'tmp')
+        os.makedirs(temp_folder, exist_ok=True)
+        temp_path = download_temp(file_url, temp_folder)
+        if temp_path == 0:
+            return 0
+
+        file_hash = hash_file(temp_path)
+        stored_path = blob_path(file_hash)
+        if os.path.exists(stored_path):
+            os.remove(temp_path)  # Same content is already stored
+        else:
+            os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+            os.replace(temp_path, stored_path)
+
+        database.file_insert(cursor, file["FileID"], file_hash, os.path.getsize(stored_path), cnx, file["FileName"])
+    return link(stored_path, path)
+
+# Function to save one attachment of a form, skipping the API call if it is already on disk.
+# Returns the file path, or 0 if it couldn't be downloaded.  Raises api.LimitReached if the daily
+# budget is used up before its download URL is fetched.
+def fetch(file, dest_folder):
+    path = file_path(dest_folder, file["FileName"])
+    if is_complete(path, file):
+        metrics.count("files_skipped")
+        return path
+
+    if blob_store_enabled():
+        return fetch_blob(file, path)
+
+    file_url = api.fetch_file_url(file["FileID"])
+    if not file_url:
+        return 0
+    return download(file_url, dest_folder, file["FileName"])
+
+# Function to save all of a form's attachments in parallel.  Returns one result per file.
+def fetch_all(files, dest_folder):
+    global _executor
+
+    if len(files) <= 1:
+        return [fetch(file, dest_folder) for file in files]
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.get('attachment_workers', 8))
+
+    return list(_executor.map(lambda file: fetch(file, dest_folder), files))
@@ -0,0 +1,218 @@
+"""Run the full export against the mock Cube API and report throughput, peak memory and stage times.
+
+Each run gets its own working folder (definitions, export files and run report) and starts
+from an empty benchmark database, so runs at different sizes are comparable.
+
+    python bench/benchmark.py --forms 1000 10000 100000
+    python bench/benchmark.py --backend mysql --database lighthouse_bench
+
+With the default SQLite backend each run gets a new database file in its working folder.
+A MySQL benchmark database must already have the tables from schema.sql.  Everything in it is
+deleted before each run, so never point --database at the live export database.
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock_cube
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+EXAMPLES = os.path.join(ROOT, 'examples')
+MAIN = os.path.join(ROOT, 'main.py')
+
+# Tables emptied before every run
+TABLES = ("jobs", "files", "api_usage", "forms", "processes", "`groups`")
+
+# Function to load the base config.json the benchmark settings are layered on
+def base_config(path):
+    with open(path, 'r') as config_file:
+        return json.load(config_file)
+
+# Function to empty the benchmark database (SQLite runs start with a new file instead)
+def reset_database(settings):
+    if settings.get('db_backend') == 'sqlite':
+        return
+
+    import mysql.connector
+
+    cnx = mysql.connector.connect(
+        user=settings['sql_user'], password=settings['sql_pass'],
+        host=settings['sql_host'], database=settings['sql_database']
+    )
+    cursor = cnx.cursor()
+    for table in TABLES:
+        cursor.execute(f"DELETE FROM {table}")
+    cnx.commit()
+    cursor.close()
+    cnx.close()
+
+# Function to create a working folder with definitions for every mock process
+def make_workdir(cube, html):
+    workdir = tempfile.mkdtemp(prefix='lighthouse-bench-')
+    names = ['toc.json', 'report.json'] + (['html.json', 'layout.html'] if html else [])
+    for process_id in range(mock_cube.FIRST_PROCESS_ID, mock_cube.FIRST_PROCESS_ID + cube.processes):
+        input_dir = os.path.join(workdir, str(process_id))
+        os.makedirs(input_dir)
+        for name in names:
+            shutil.copy(os.path.join(EXAMPLES, name), input_dir)
+    os.makedirs(os.path.join(workdir, 'assets'))
+    return workdir
+
+# Function to write the config.json used by a run
+def write_config(settings, workdir, base_url, cube, overrides):
+    settings = dict(settings)
+    settings.update({
+        "cube_api": "benchmark",
+        "files": os.path.join(workdir, 'files'),
+        "sqlite_path": os.path.join(workdir, 'lighthouse.db'),
+        "assets": os.path.join(workdir, 'assets'),
+        "blob_store": "",
+        "prometheus_textfile": "",
+        "api_urls": mock_cube.api_urls(base_url),
+        "api_daily_limit": cube.forms * (cube.attachments + 1) * 2 + 1000,
+        "api_quota_reserve": 0,
+        "api_calls_per_second": 0,
+    })
+    settings.update(overrides)
+
+    config_path = os.path.join(workdir, 'config.json')
+    with open(config_path, 'w') as config_file:
+        json.dump(settings, config_file, indent=2)
+    return config_path
+
+# Function to run main.py and return (exit code, wall seconds, peak RSS in MB or None)
+def run_export(workdir, config_path, main_args):
+    env = dict(os.environ, LIGHTHOUSE_CONFIG=config_path)
+    with open(os.path.join(workdir, 'export.log'), 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, MAIN] + main_args, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+        if not hasattr(os, 'wait4'):
+            return process.wait(), time.perf_counter() - start, None  # No rusage on Windows
+
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        elapsed = time.perf_counter() - start
+
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return process.returncode, elapsed, peak_rss
+
+# Function to load the run report main.py wrote
+def load_report(workdir):
+    reports = sorted(glob.glob(os.path.join(workdir, 'files', '_reports', 'run-*.json')))
+    if not reports:
+        return None
+    with open(reports[-1], 'r') as report_file:
+        return json.load(report_file)
+
+# Function to run one benchmark size and return its results
+def bench(size, args, settings, overrides):
+    cube = mock_cube.MockCube(
+        processes=args.processes, forms=size, attachments=args.attachments,
+        attachment_size=args.attachment_size, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, daily_limit=args.daily_limit
+    )
+    server, base_url = mock_cube.serve(cube)
+    workdir = make_workdir(cube, args.html)
+    try:
+        reset_database(settings)
+        config_path = write_config(settings, workdir, base_url, cube, overrides)
+
+        main_args = ['--engine', args.engine] + ([] if args.html else ['--nocloud'])
+        exit_code, wall, peak_rss = run_export(workdir, config_path, main_args)
+        report = load_report(workdir) or {"stages": {}, "counters": {}}
+
+        export_seconds = report["stages"].get("export", {}).get("sum") or wall
+        forms_done = report["counters"].get("forms_completed", 0)
+        return {
+            "forms": size,
+            "forms_exported": forms_done,
+            "exit_code": exit_code,
+            "wall_seconds": round(wall, 3),
+            "export_seconds": round(export_seconds, 3),
+            "forms_per_second": round(forms_done / export_seconds, 2) if export_seconds else 0,
+            "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+            "api_calls": cube.calls,
+            "stages": {stage: {"count": values["count"], "sum": values["sum"], "mean": values["mean"]}
+                       for stage, values in report["stages"].items()},
+            "counters": report["counters"],
+            "workdir": workdir,
+        }
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+# Function to print a results table
+def print_results(results):
+    print()
+    print(f"{'forms':>8} {'exported':>9} {'seconds':>9} {'forms/s':>9} {'peak MB':>9} {'API calls':>10}")
+    for result in results:
+        peak = result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-'
+        print(f"{result['forms']:>8} {result['forms_exported']:>9} {result['export_seconds']:>9} "
+              f"{result['forms_per_second']:>9} {peak:>9} {result['api_calls']:>10}")
+
+    for result in results:
+        print()
+        print(f"Stage times for {result['forms']} forms (exit code {result['exit_code']}):")
+        for stage, values in result["stages"].items():
+            print(f"    {stage:<24} count {values['count']:>8}  total {values['sum']:>10.3f}s  mean {values['mean'] * 1000:>9.2f}ms")
+
+# Function to parse --set key=value overrides (values are read as JSON where possible)
+def parse_overrides(pairs):
+    overrides = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the export against a mock Cube API")
+    parser.add_argument('--config', default=os.path.join(ROOT, 'config.json'), help="Base config.json (for SQL credentials)")
+    parser.add_argument('--backend', choices=['sqlite', 'mysql'], default='sqlite', help="Database backend to benchmark")
+    parser.add_argument('--database', help="MySQL benchmark database.  It is emptied before every run.")
+    parser.add_argument('--forms', type=int, nargs='+', default=[1000, 10000, 100000], help="Form counts to run")
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--attachments', type=int, default=0, help="Attachments per form")
+    parser.add_argument('--attachment-size', type=int, default=100 * 1024, help="Attachment size in bytes")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds added to every API call")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Random extra seconds per API call")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of API calls that return HTTP 500")
+    parser.add_argument('--daily-limit', type=int, default=0, help="Calls before 'API daily limit reached' (0 = none)")
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--html', action='store_true', help="Also render HTML and PDF (needs wkhtmltopdf)")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="Override a config.json setting")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--keep', action='store_true', help="Keep each run's working folder")
+    args = parser.parse_args()
+
+    settings = base_config(args.config)
+    settings['db_backend'] = args.backend
+    if args.backend == 'mysql':
+        if not args.database or args.database == settings.get('sql_database'):
+            print("MySQL benchmarks need a separate --database, as it is emptied before every run.")
+            sys.exit(1)
+        settings['sql_database'] = args.database
+    overrides = parse_overrides(args.set)
+
+    results = []
+    for size in args.forms:
+        print(f"Benchmarking {size} forms...")
+        results.append(bench(size, args, settings, overrides))
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+        print(f"\nResults saved to {args.output}")
@@ -0,0 +1,85 @@
+"""Check that the hot database lookups use an index instead of scanning the whole table.
+
+Runs EXPLAIN (MySQL) or EXPLAIN QUERY PLAN (SQLite) on the queries the exporter runs for every
+form or process, against the database in config.json (or LIGHTHOUSE_CONFIG), after bringing
+its schema up to date.  Exits with status 1 if any of them would scan a whole table.
+
+    python bench/check_indexes.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import database
+
+# Fills in the fields of a query template the way database.py does when it runs the query
+def query(template, **fields):
+    return template.format(**fields)
+
+# (description, query, parameters) for each lookup that has to stay indexed.  The queries are the
+# ones database.py runs, so a change there is checked here too.
+QUERIES = [
+    ("form_iter", database.FORM_ITER_QUERY, (1, 0, 1000)),
+    ("process_claim", query(
+        database.PROCESS_CLAIM_QUERY,
+        excluded=query(database.EXCLUDE_PROCESSES, placeholders="%s"), lock=database._sql(*database.SKIP_LOCKED)
+    ), ("node", "2000-01-01 00:00:00", 2)),
+    ("form_insert_many", database.FORM_EXISTING_QUERY, (1,)),
+    ("form_complete_many", query(database.FORM_COMPLETE_MANY_QUERY, placeholders="%s, %s"), ("2000-01-01 00:00:00", 1, 2)),
+    ("form_complete_many jobs", query(database.JOB_DELETE_MANY_QUERY, placeholders="%s, %s"), (1, 2)),
+    ("process_reset", database.PROCESS_RESET_QUERY, (1,)),
+    ("process_reset jobs", database.PROCESS_RESET_JOBS_QUERY, (1,)),
+    ("job_claim insert", query(database.JOB_INSERT_QUERY, insert=database._sql(*database.INSERT_IGNORE)), (1, 1)),
+    ("job_claim", database.JOB_CLAIM_QUERY, ("node", "2000-01-01 00:00:00", 1, "node", "2000-01-01 00:00:00")),
+    ("job_stage", query(database.JOB_STAGE_QUERY, columns="Fetched = 1, DataPath = %s"), ("path", "2000-01-01 00:00:00", "2000-01-01 00:00:00", 1)),
+    ("job_release", database.JOB_RELEASE_QUERY, ("node",)),
+    ("claims_renew", database.CLAIMS_RENEW_QUERY, ("2000-01-01 00:00:00", "node")),
+    ("claims_renew jobs", database.CLAIMS_RENEW_JOBS_QUERY, ("2000-01-01 00:00:00", "node")),
+    ("file_hash", database.FILE_HASH_QUERY, (1,)),
+]
+
+# Tables a lookup may still scan, by description.  process_claim walks the processes catalogue (one
+# row per process) in order, but the forms it checks for each process must come from an index.
+ALLOWED_SCANS = {
+    "process_claim": {"p"},
+}
+
+# Function to return the full table scans in a query plan, leaving out scans of the allowed tables
+def full_scans(cursor, query, params, allowed=()):
+    if database.backend() == 'sqlite':
+        cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+        # eg. "SCAN forms" is a full scan, "SEARCH forms USING INDEX ..." is not
+        return [
+            row[3] for row in cursor.fetchall()
+            if row[3].startswith("SCAN ") and row[3].split()[1] not in allowed
+        ]
+
+    cursor.execute("EXPLAIN " + query, params)
+    columns = [column[0] for column in cursor.description]
+    scans = []
+    for row in cursor.fetchall():
+        plan = dict(zip(columns, row))
+        # MySQL may still pick a scan for a near-empty table, so only fail when no index could be used
+        if plan.get("type") == "ALL" and not plan.get("possible_keys") and plan.get("table") not in allowed:
+            scans.append(f"full scan of {plan.get('table')}")
+    return scans
+
+if __name__ == "__main__":
+    cnx = database.setup()
+    cursor = cnx.cursor()
+
+    print(f"Checking query plans ({database.backend()}, schema version {database.schema_version(cursor)})...")
+    failed = False
+    for name, query, params in QUERIES:
+        scans = full_scans(cursor, query, params, ALLOWED_SCANS.get(name, ()))
+        if scans:
+            failed = True
+            print(f"    FAIL {name}: {'; '.join(scans)}")
+        else:
+            print(f"    OK   {name}")
+
+    cnx.rollback()
+    cursor.close()
+    cnx.close()
+    sys.exit(1 if failed else 0)
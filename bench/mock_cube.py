@@ -0,0 +1,213 @@
+"""Local stand-in for the Cube API, used to benchmark exports without spending API quota.
+
+Serves Procs, ProcFormList, ProcForm and ProcFormFile from synthetic data modelled on
+examples/lighthouse_api_response_example.json, plus the attachment downloads.
+
+    python bench/mock_cube.py --forms 10000 --latency 0.05 --error-rate 0.001
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'lighthouse_api_response_example.json')
+
+GROUP_ID = 1
+FIRST_PROCESS_ID = 1000
+FIRST_FORM_ID = 100000
+
+# Function to load the example ProcForm response used as the template for every form
+def load_template():
+    with open(EXAMPLE, 'r') as example_file:
+        text = example_file.read()
+    return json.loads(re.sub(r',(\s*[\]}])', r'\1', text))  # The example has trailing commas
+
+class MockCube:
+    def __init__(self, processes=1, forms=1000, attachments=0, attachment_size=100 * 1024,
+                 latency=0.0, jitter=0.0, error_rate=0.0, daily_limit=0, seed=1):
+        self.processes = processes
+        self.forms = forms
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.daily_limit = daily_limit
+        self.random = random.Random(seed)
+        self.template = load_template()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    # Function to return the ProcessID a FormID belongs to
+    def process_of(self, form_id):
+        return FIRST_PROCESS_ID + (form_id - FIRST_FORM_ID) % self.processes
+
+    def form_ids(self, process_id):
+        start = FIRST_FORM_ID + (process_id - FIRST_PROCESS_ID)
+        return range(start, FIRST_FORM_ID + self.forms, self.processes)
+
+    def procs(self):
+        return {"Result": {
+            "Procs": [
+                {
+                    "ProcessID": process_id, "Process": f"Benchmark {process_id}", "Enabled": True,
+                    "Added": "2024-01-01", "Modified": "2024-09-15", "Forms": len(self.form_ids(process_id)),
+                    "Archived": 0, "Fields": 30, "GroupID": GROUP_ID, "RepeatingFields": False
+                }
+                for process_id in range(FIRST_PROCESS_ID, FIRST_PROCESS_ID + self.processes)
+            ],
+            "Groups": [{"GroupID": GROUP_ID, "Group": "Benchmark"}],
+        }}
+
+    def form_list(self, process_id):
+        return {"Result": {"Forms": [
+            {"ID": form_id, "Number": f"{form_id:06d}", "Archived": False, "Modified": "2024-09-15 09:17:40"}
+            for form_id in self.form_ids(process_id)
+        ]}}
+
+    def form(self, form_id):
+        data = copy.deepcopy(self.template)
+        form = data["Result"]["Form"]
+        data["Result"]["ProcessID"] = self.process_of(form_id)
+        form["FormID"] = form_id
+        form["Number"] = f"{form_id:06d}"
+        form["Started"] = f"2024-{form_id % 12 + 1:02d}-15 09:17:39"
+        form["Files"] = [
+            {"FileName": f"attachment_{index}.pdf", "FileID": form_id * 100 + index,
+             "Size": self.attachment_size / 1024, "Folder": "", "Description": ""}
+            for index in range(self.attachments)
+        ]
+        return data
+
+    # Function to count a call and work out whether it should fail
+    def call(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.random.random() * self.jitter)
+        with self.lock:
+            self.calls += 1
+            if self.daily_limit and self.calls > self.daily_limit:
+                return {"Result": {"Error": {"Message": "API daily limit reached"}}}
+            if self.error_rate and self.random.random() < self.error_rate:
+                return 500
+        return None
+
+def make_handler(cube):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, body, status=200):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+            endpoint = self.path.rstrip('/').rsplit('/', 1)[-1]
+
+            failure = cube.call()
+            if failure == 500:
+                return self.send_json({"Message": "Internal error"}, 500)
+            if failure is not None:
+                return self.send_json(failure)
+
+            if endpoint == 'Procs':
+                self.send_json(cube.procs())
+            elif endpoint == 'ProcFormList':
+                self.send_json(cube.form_list(int(request["ProcessID"])))
+            elif endpoint == 'ProcForm':
+                self.send_json(cube.form(int(request["FormID"])))
+            elif endpoint == 'ProcFormFile':
+                host = self.headers.get('Host')
+                self.send_json({"Result": {"DownloadUrl": f"http://{host}/download/{request['FileID']}"}})
+            else:
+                self.send_json({"Message": "Unknown endpoint"}, 404)
+
+        def do_GET(self):
+            if not self.path.startswith('/download/'):
+                return self.send_json({"Message": "Not found"}, 404)
+
+            size = cube.attachment_size
+            start = 0
+            match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            if match and int(match.group(1)) < size:
+                start = int(match.group(1))
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size - start))
+            self.end_headers()
+
+            block = b'\0' * 65536
+            remaining = size - start
+            while remaining > 0:
+                chunk = block[:min(remaining, len(block))]
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    return Handler
+
+# Server with a listen backlog deep enough for the async engine's concurrency
+class MockServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+
+# Function to start the mock server on a background thread.  Returns (server, base_url).
+def serve(cube, host='127.0.0.1', port=0):
+    server = MockServer((host, port), make_handler(cube))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/rpm/api2.svc/"
+
+# Function to return the api_urls settings for a mock server
+def api_urls(base_url):
+    return {
+        "processes": base_url + "Procs",
+        "groups": base_url + "Procs",
+        "forms": base_url + "ProcFormList",
+        "data": base_url + "ProcForm",
+        "files": base_url + "ProcFormFile",
+    }
+
+def parser():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Cube API")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--processes', type=int, default=1, help="Number of processes")
+    parser.add_argument('--forms', type=int, default=1000, help="Total number of forms")
+    parser.add_argument('--attachments', type=int, default=0, help="Attachments per form")
+    parser.add_argument('--attachment-size', type=int, default=100 * 1024, help="Attachment size in bytes")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every API call")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Random extra seconds per API call")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of API calls that return HTTP 500")
+    parser.add_argument('--daily-limit', type=int, default=0, help="Calls before 'API daily limit reached' (0 = none)")
+    return parser
+
+def cube_from_args(args):
+    return MockCube(
+        processes=args.processes, forms=args.forms, attachments=args.attachments,
+        attachment_size=args.attachment_size, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, daily_limit=args.daily_limit
+    )
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    server, base_url = serve(cube_from_args(args), port=args.port)
+    print(f"Mock Cube API listening on {base_url}")
+    print(json.dumps({"api_urls": api_urls(base_url)}, indent=2))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
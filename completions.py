@@ -0,0 +1,130 @@
+import config
+import database
+import metrics
+import threading
+import time
+
+# Load settings file
+settings = config.load()
+
+# Forms waiting to be marked completed, as (FormID, event set once written or None)
+_pending = []
+_condition = threading.Condition()
+_writer_thread = None
+_stopping = False
+_writing = False
+
+# Function to return the completion mode set in config.json:
+#   "immediate" - every form is committed on its own before the export thread moves on
+#   "group"     - export threads wait while their forms are committed together in one batch
+#   "async"     - forms are committed in the background and export threads don't wait (default).
+#                 A crash can lose up to completion_interval seconds of completions, and those
+#                 forms are exported again by the next run.
+def mode():
+    return settings.get('completion_mode', 'async')
+
+# Function to start the background writer
+def start():
+    global _writer_thread, _stopping
+
+    if _writer_thread is not None or mode() == 'immediate':
+        return
+
+    _stopping = False
+    _writer_thread = threading.Thread(target=_writer, daemon=True)
+    _writer_thread.start()
+
+# Function to mark a form as completed in the database, using the mode set in config.json
+def complete(form_id):
+    if _writer_thread is None:
+        cnx, cursor = database.thread_setup()
+        with metrics.timer("db_complete"):
+            database.form_complete(cursor, form_id, cnx)
+        metrics.count("forms_completed")
+        return
+
+    done = threading.Event() if mode() == 'group' else None
+    with _condition:
+        _pending.append((form_id, done))
+        if done is not None or len(_pending) >= settings.get('completion_batch', 500):
+            _condition.notify_all()
+
+    if done is not None:
+        with metrics.timer("db_complete_wait"):
+            done.wait()
+
+# Function to write every queued completion now, from the calling thread
+def flush():
+    with _condition:
+        _condition.wait_for(lambda: not _writing)  # Let a batch already being written finish
+        batch = _pending[:]
+        del _pending[:]
+
+    if batch:
+        cnx, cursor = database.thread_setup()
+        _write(cursor, cnx, batch)
+
+# Function to write the queued completions and stop the background writer
+def stop():
+    global _writer_thread, _stopping
+
+    if _writer_thread is None:
+        return
+
+    with _condition:
+        _stopping = True
+        _condition.notify_all()
+    _writer_thread.join()
+    _writer_thread = None
+
+def _writer():
+    global _writing
+
+    cnx = database.setup()
+    cursor = cnx.cursor()
+    batch_size = settings.get('completion_batch', 500)
+    interval = settings.get('completion_interval', 2)
+
+    # In "group" mode a batch is written as soon as the last one is committed, so it holds
+    # every form that finished while the writer was busy and nobody waits for the interval
+    def ready():
+        return _stopping or len(_pending) >= batch_size or (_pending and _pending[0][1] is not None)
+
+    while True:
+        with _condition:
+            deadline = time.monotonic() + interval
+            while not ready():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                _condition.wait(remaining)
+
+            batch = _pending[:batch_size]
+            del _pending[:batch_size]
+            _writing = bool(batch)
+            finished = _stopping and not _pending
+
+        if batch:
+            _write(cursor, cnx, batch)
+            with _condition:
+                _writing = False
+                _condition.notify_all()
+        if finished:
+            break
+
+    cursor.close()
+    cnx.close()
+
+# Function to commit a batch of completions and release the threads waiting on it.  If the batch
+# can't be written its forms stay not completed and are exported again by the next run.
+def _write(cursor, cnx, batch):
+    try:
+        with metrics.timer("db_complete_batch"):
+            database.form_complete_many(cursor, [form_id for form_id, _ in batch], cnx)
+        metrics.count("forms_completed", len(batch))
+    except Exception:
+        pass  # Already reported by database.form_complete_many
+    finally:
+        for _, done in batch:
+            if done is not None:
+                done.set()
@@ -1,6 +1,10 @@
 import json
+import os
 
-def load(config_file='config.json'):
+# The settings file can be changed with the LIGHTHOUSE_CONFIG environment variable,
+# eg. to give each node of a sharded export its own API key
+def load(config_file=None):
+    config_file = config_file or os.environ.get('LIGHTHOUSE_CONFIG', 'config.json')
     with open(config_file, 'r') as f:
         config = json.load(f)
     return config
\ No newline at end of file
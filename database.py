@@ -1,38 +1,246 @@
 import config
-import mysql.connector
+from datetime import date, datetime
+import os
+import re
+import sqlite3
 import sys
+import threading
+import weakref
+
+try:
+    import mysql.connector
+    from mysql.connector import pooling
+except ImportError:
+    mysql = None  # Only needed with db_backend "mysql"
 
 # Load settings file
 settings = config.load()
 
+# Thread-local storage for database connections
+thread_local = threading.local()
+
+# MySQL connection pool and schema migration state, set up on first connection
+_pool = None
+_pool_lock = threading.Lock()
+_migrated = False
+_migrate_lock = threading.Lock()
+
+# Schema used to create a new SQLite database, and the folder of versioned migrations
+# (migrations/<backend>/NNN_name.sql) applied to existing databases
+SQLITE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema_sqlite.sql')
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Store dates and datetimes in SQLite as ISO text so they compare in order
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+
+# SQLite cursor accepting the MySQL-style %s placeholders used throughout this module
+class _SQLiteCursor(sqlite3.Cursor):
+    def execute(self, query, params=()):
+        return super().execute(query.replace('%s', '?'), params)
+
+    def executemany(self, query, params):
+        return super().executemany(query.replace('%s', '?'), params)
+
+class _SQLiteConnection(sqlite3.Connection):
+    def cursor(self, factory=_SQLiteCursor):
+        return super().cursor(factory)
+
+# Function to return the database backend set in config.json ("mysql" or "sqlite")
+def backend():
+    return settings.get('db_backend', 'mysql')
+
+# Function to pick the MySQL or SQLite version of a query
+def _sql(mysql_query, sqlite_query):
+    return sqlite_query if backend() == 'sqlite' else mysql_query
+
+# Function to open a connection to the SQLite database in WAL mode
+def _sqlite_connect():
+    cnx = sqlite3.connect(
+        settings.get('sqlite_path', 'lighthouse.db'), timeout=30, factory=_SQLiteConnection,
+        check_same_thread=False  # Each connection is used by one thread, but may be closed by another
+    )
+    cnx.execute("PRAGMA journal_mode = WAL")  # Readers don't block the writer
+    cnx.execute("PRAGMA synchronous = NORMAL")  # WAL is still crash-safe, without an fsync per commit
+    return cnx
+
+# Function to return the MySQL connection pool, created on first use
+def _mysql_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = pooling.MySQLConnectionPool(
+                pool_name="lighthouse",
+                pool_size=min(settings.get('db_pool_size', 32), pooling.CNX_POOL_MAXSIZE),
+                user=settings['sql_user'],
+                password=settings['sql_pass'],
+                host=settings['sql_host'],
+                database=settings['sql_database']
+            )
+        return _pool
+
+# Function to open a database connection.  MySQL connections come from the pool (closing one
+# returns it to the pool) and a plain connection is opened if every pooled one is in use.
+def _connect():
+    if backend() == 'sqlite':
+        return _sqlite_connect()
+
+    try:
+        return _mysql_pool().get_connection()
+    except mysql.connector.errors.PoolError:
+        return mysql.connector.connect(
+            user=settings['sql_user'],
+            password=settings['sql_pass'],
+            host=settings['sql_host'],
+            database=settings['sql_database']
+        )
+
+# Function to open a database connection.  The first connection of a run brings the schema
+# up to date before it is returned.
 def setup():
-    global settings
-    
+    global _migrated
+
     try:
-        db_settings = {
-            'user': settings['sql_user'],
-            'password': settings['sql_pass'],
-            'host': settings['sql_host'],
-            'database': settings['sql_database']
-        }
-        cnx = mysql.connector.connect(**db_settings)
+        cnx = _connect()
     except Exception as e:
         print(f"Error connecting to SQL database: {e}")
         sys.exit(1)
-        
+
+    if not _migrated:
+        with _migrate_lock:
+            if not _migrated:
+                try:
+                    migrate(cnx)
+                except Exception as e:
+                    print(f"Error updating database schema: {e}")
+                    sys.exit(1)
+                _migrated = True
+
     return cnx
 
-# Function to insert data into groups table
-def group_insert(cursor, group, cnx):
+# Function to return the migrations for the database backend as (version, path), in order
+def migrations():
+    folder = os.path.join(MIGRATIONS, backend())
+    found = []
+    for name in os.listdir(folder):
+        match = re.match(r'(\d+)_.+\.sql$', name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(folder, name)))
+    return sorted(found)
+
+# Function to return the schema version of the database (0 for a database from before migrations)
+def schema_version(cursor):
+    cursor.execute("SELECT MAX(Version) FROM schema_version")
+    return cursor.fetchone()[0] or 0
+
+# Error numbers MySQL returns for a table, column or index that already exists
+_EXISTS_ERRORS = (1050, 1060, 1061, 1068)
+
+# Function to run a migration statement, skipping tables, columns and indexes that already exist.
+# Databases created from the schema of an earlier version of the tool have some of them.
+def _apply(cursor, statement):
+    try:
+        cursor.execute(statement)
+    except sqlite3.OperationalError as e:
+        if "duplicate column" not in str(e) and "already exists" not in str(e):
+            raise
+    except Exception as e:
+        if getattr(e, 'errno', None) not in _EXISTS_ERRORS:
+            raise
+
+# Function to split a migration file into statements, leaving out comment lines
+def _statements(path):
+    with open(path, 'r') as sql_file:
+        lines = [line for line in sql_file if not line.lstrip().startswith('--')]
+    return [statement.strip() for statement in ''.join(lines).split(';') if statement.strip()]
+
+# Function to apply the migrations newer than the database's schema version.  A new SQLite
+# database is created from schema_sqlite.sql first.  Nodes starting at the same time take turns
+# (a MySQL named lock, or the SQLite write lock) so each migration is only applied once.
+def migrate(cnx):
+    cursor = cnx.cursor()
     try:
-        if not group_exists(cursor, group["GroupID"]):
-            insert_group_query = "INSERT INTO groups (ID, Name) VALUES (%s, %s)"
-            group_data = (group["GroupID"], group["Group"].replace('/', '').replace('"', '').strip())
-            cursor.execute(insert_group_query, group_data)
-            cnx.commit()  # Commit after inserting
+        if backend() == 'sqlite':
+            cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'forms'")
+            if cursor.fetchone()[0] == 0:
+                with open(SQLITE_SCHEMA, 'r') as schema_file:
+                    cnx.executescript(schema_file.read())
+        else:
+            cursor.execute("SELECT GET_LOCK('lighthouse_migrate', 300)")
+            cursor.fetchone()
+
+        try:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS schema_version (Version int NOT NULL PRIMARY KEY, Applied datetime NOT NULL)"
+            )
+            cnx.commit()
+
+            for version, path in migrations():
+                if backend() == 'sqlite':
+                    cursor.execute("BEGIN IMMEDIATE")  # DDL is transactional in SQLite
+                if version <= schema_version(cursor):
+                    cnx.commit()
+                    continue
+
+                print(f"Applying database migration {os.path.basename(path)}...")
+                for statement in _statements(path):
+                    _apply(cursor, statement)
+                cursor.execute(
+                    "INSERT INTO schema_version (Version, Applied) VALUES (%s, %s)", (version, datetime.now())
+                )
+                cnx.commit()
+        finally:
+            if backend() != 'sqlite':
+                cursor.execute("SELECT RELEASE_LOCK('lighthouse_migrate')")
+                cursor.fetchone()
+    finally:
+        cursor.close()
+
+# Holds a thread's connection so it can be closed (returned to the pool) when the thread ends
+class _ThreadConnection:
+    pass
+
+def _release(cnx, cursor):
+    try:
+        cursor.close()
+        cnx.close()
+    except Exception:
+        pass
+
+# Function to get or create the calling thread's database connection and cursor
+def thread_setup():
+    if not hasattr(thread_local, 'cnx'):
+        thread_local.cnx = setup()
+        thread_local.cursor = thread_local.cnx.cursor()
+        thread_local.holder = _ThreadConnection()
+        weakref.finalize(thread_local.holder, _release, thread_local.cnx, thread_local.cursor)
+    return thread_local.cnx, thread_local.cursor
+
+# Function to run executemany in chunks so very large batches stay under max_allowed_packet
+def _executemany(cursor, query, rows, chunk_size=1000):
+    for start in range(0, len(rows), chunk_size):
+        cursor.executemany(query, rows[start:start + chunk_size])
+
+# Function to insert or update many groups in one transaction
+def group_insert_many(cursor, groups, cnx):
+    try:
+        insert_group_query = _sql("""
+            INSERT INTO groups (ID, Name) VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE Name = VALUES(Name)
+        """, """
+            INSERT INTO groups (ID, Name) VALUES (%s, %s)
+            ON CONFLICT (ID) DO UPDATE SET Name = excluded.Name
+        """)
+        group_data = [
+            (group["GroupID"], group["Group"].replace('/', '').replace('"', '').strip())
+            for group in groups
+        ]
+        _executemany(cursor, insert_group_query, group_data)
+        cnx.commit()  # Commit once for the whole batch
     except Exception as e:
-        print(f"Error inserting group into database - {group['Group']}: {e}")
-        raise  # Raising the exception allows higher-level code to handle it properly
+        print(f"Error inserting groups into database: {e}")
+        raise
 
 # Function to return name of group for a ProcessID
 def group_name(cursor, proc_id):
@@ -42,50 +250,141 @@ def group_name(cursor, proc_id):
     
     return result[0] if result else "Unsorted"
 
-# Function to get list of forms for a process
-def form_fetch(cursor, proc_id):
-    query = "SELECT Form FROM forms WHERE ProcessID = %s AND Completed = 0"
+# Function to count the forms of a process that are left to export
+def form_count(cursor, proc_id):
+    query = "SELECT COUNT(*) FROM forms WHERE ProcessID = %s AND Completed = 0"
     cursor.execute(query, (proc_id,))
-    return [form_id[0] for form_id in cursor.fetchall()]
+    return cursor.fetchone()[0]
+
+# Queries run for every form or process.  bench/check_indexes.py checks these same strings use an
+# index, so change them here rather than copying them.  Fields in braces are filled in when the
+# query is run: {placeholders} with one %s per value, {lock} with SKIP_LOCKED and {insert} with
+# INSERT_IGNORE (both picked for the backend with _sql), {excluded} with EXCLUDE_PROCESSES or
+# nothing, and {columns} with the job columns being set.
+FORM_ITER_QUERY = """
+    SELECT Form FROM forms
+    WHERE ProcessID = %s AND Completed = 0 AND Form > %s
+    ORDER BY Form ASC
+    LIMIT %s
+"""
+FORM_EXISTING_QUERY = "SELECT Form, Archived, Modified FROM forms WHERE ProcessID = %s"
+FORM_COMPLETE_MANY_QUERY = "UPDATE forms SET Completed = 1, Exported = %s WHERE Form IN ({placeholders})"
+JOB_DELETE_MANY_QUERY = "DELETE FROM jobs WHERE Form IN ({placeholders})"
+PROCESS_CLAIM_QUERY = """
+    SELECT p.ProcessID, p.Process, p.GroupID FROM processes p
+    WHERE p.Enabled = 1
+      AND (p.ClaimedBy IS NULL OR p.ClaimedBy = %s OR p.ClaimExpires < %s)
+      AND EXISTS (SELECT 1 FROM forms f WHERE f.ProcessID = p.ProcessID AND f.Completed = 0)
+      {excluded}
+    ORDER BY p.ProcessID ASC
+    LIMIT 1
+    {lock}
+"""
+EXCLUDE_PROCESSES = "AND p.ProcessID NOT IN ({placeholders})"
+SKIP_LOCKED = ("FOR UPDATE SKIP LOCKED", "")
+PROCESS_RESET_QUERY = "UPDATE forms SET Completed = 0 WHERE ProcessID = %s"
+PROCESS_RESET_JOBS_QUERY = "DELETE FROM jobs WHERE ProcessID = %s"
+CLAIMS_RENEW_QUERY = "UPDATE processes SET ClaimExpires = %s WHERE ClaimedBy = %s"
+CLAIMS_RENEW_JOBS_QUERY = "UPDATE jobs SET LeaseExpires = %s WHERE LeaseOwner = %s"
+FILE_HASH_QUERY = "SELECT Hash FROM files WHERE FileID = %s"
+JOB_INSERT_QUERY = """
+    {insert} INTO jobs (Form, ProcessID, Attempts)
+    SELECT Form, %s, 0 FROM forms WHERE Form = %s AND Completed = 0
+"""
+INSERT_IGNORE = ("INSERT IGNORE", "INSERT OR IGNORE")
+JOB_CLAIM_QUERY = """
+    UPDATE jobs SET LeaseOwner = %s, LeaseExpires = %s, Attempts = Attempts + 1
+    WHERE Form = %s AND (LeaseOwner IS NULL OR LeaseOwner = %s OR LeaseExpires < %s)
+      AND EXISTS (SELECT 1 FROM forms f WHERE f.Form = jobs.Form AND f.Completed = 0)
+"""
+JOB_STAGE_QUERY = "UPDATE jobs SET {columns}, Updated = %s, LeaseExpires = %s WHERE Form = %s"
+JOB_RELEASE_QUERY = "UPDATE jobs SET LeaseOwner = NULL, LeaseExpires = NULL WHERE LeaseOwner = %s"
+
+# Function to fill in the {placeholders} field of a query for values
+def _placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+# Generator yielding the forms of a process left to export, one page at a time.  Pages are read
+# in Form order starting after the last form of the previous page, so each page is one index
+# range read however far into the process it is, and forms completed meanwhile are never re-read.
+def form_iter(cursor, proc_id, cnx, page_size=1000):
+    last_form = -1
+    while True:
+        cnx.commit()  # Read each page from a fresh snapshot
+        cursor.execute(FORM_ITER_QUERY, (proc_id, last_form, page_size))
+        page = [row[0] for row in cursor.fetchall()]
+        if not page:
+            return
+        yield from page
+        if len(page) < page_size:
+            return
+        last_form = page[-1]
 
 # Function to update the database to set Completed to 1
 def form_complete(cursor, form_id, cnx):
-    update_query = "UPDATE forms SET Completed = 1 WHERE Form = %s"
-    cursor.execute(update_query, (form_id,))
+    update_query = "UPDATE forms SET Completed = 1, Exported = %s WHERE Form = %s"
+    cursor.execute(update_query, (datetime.now(), form_id))
+    cursor.execute("DELETE FROM jobs WHERE Form = %s", (form_id,))  # The form's work is finished
     cnx.commit()  # Commit after updating the form status
 
-# Function to check if a record exists in the forms table
-def form_exists(cursor, process_id, form_id):
-    check_query = "SELECT COUNT(*) FROM forms WHERE ProcessID = %s AND Form = %s"
-    cursor.execute(check_query, (process_id, form_id))
-    return cursor.fetchone()[0] > 0
-
-# Function to insert data into forms table
-def form_insert(cursor, process_id, form, cnx):
-    try:
-        if not form_exists(cursor, process_id, form["ID"]):
-            insert_form_query = """
-            INSERT INTO forms (ProcessID, Form, Archived)
-            VALUES (%s, %s, %s)
-            """
-            form_data = (
-                process_id, form["ID"], form["Archived"]
-            )
-            cursor.execute(insert_form_query, form_data)
-            cnx.commit()
+# Function to set Completed to 1 for many forms with one commit
+def form_complete_many(cursor, form_ids, cnx, chunk_size=500):
+    try:
+        form_ids = list(form_ids)
+        exported = datetime.now()
+        for start in range(0, len(form_ids), chunk_size):
+            chunk = form_ids[start:start + chunk_size]
+            placeholders = _placeholders(chunk)
+            cursor.execute(FORM_COMPLETE_MANY_QUERY.format(placeholders=placeholders), [exported] + chunk)
+            cursor.execute(JOB_DELETE_MANY_QUERY.format(placeholders=placeholders), chunk)
+        cnx.commit()  # One commit for the whole group
     except Exception as e:
-        print(f"Error adding form in SQL: {e}")
+        cnx.rollback()
+        print(f"Error updating form statuses in SQL: {e}")
         raise
-        
-        
-# Function to check if a record exists in the processes table
-def process_exists(cursor, proc_id):
+
+# Function to add a process's forms in one transaction.  Existing rows are read in one query
+# and only new forms, or forms whose Archived flag or Modified stamp changed, are written.
+# Forms that were modified in Cube since they were exported are set back to Completed = 0.
+def form_insert_many(cursor, process_id, forms, cnx):
     try:
-        check_query = "SELECT COUNT(*) FROM processes WHERE ProcessID = %s"
-        cursor.execute(check_query, (proc_id,))
-        return cursor.fetchone()[0] > 0
+        cursor.execute(FORM_EXISTING_QUERY, (process_id,))
+        existing = {row[0]: (bool(row[1]), str(row[2]) if row[2] else None) for row in cursor.fetchall()}
+
+        form_data = [
+            (process_id, form["ID"], form["Archived"], form.get("Modified"))
+            for form in forms
+            if existing.get(form["ID"]) != (bool(form["Archived"]), form.get("Modified"))
+        ]
+        if form_data:
+            # Completed is assigned before Modified so it is compared against the stored stamp
+            insert_form_query = _sql("""
+                INSERT INTO forms (ProcessID, Form, Archived, Modified, Completed)
+                VALUES (%s, %s, %s, %s, 0)
+                ON DUPLICATE KEY UPDATE
+                    Completed = IF(Modified IS NULL OR Modified <=> VALUES(Modified), Completed, 0),
+                    ProcessID = VALUES(ProcessID), Archived = VALUES(Archived), Modified = VALUES(Modified)
+            """, """
+                INSERT INTO forms (ProcessID, Form, Archived, Modified, Completed)
+                VALUES (%s, %s, %s, %s, 0)
+                ON CONFLICT (Form) DO UPDATE SET
+                    Completed = CASE WHEN forms.Modified IS NULL OR forms.Modified IS excluded.Modified
+                                THEN forms.Completed ELSE 0 END,
+                    ProcessID = excluded.ProcessID, Archived = excluded.Archived, Modified = excluded.Modified
+            """)
+            _executemany(cursor, insert_form_query, form_data)
+
+            # Forms modified in Cube start their export again from scratch
+            modified = [
+                (form_id,) for _, form_id, _, stamp in form_data
+                if form_id in existing and existing[form_id][1] is not None and existing[form_id][1] != stamp
+            ]
+            if modified:
+                _executemany(cursor, "DELETE FROM jobs WHERE Form = %s", modified)
+        cnx.commit()  # Commit once per process
+        return len(form_data)
     except Exception as e:
-        print(f"Error checking process existence: {e}")
+        print(f"Error adding forms in SQL: {e}")
         raise
 
 # Function to get name of a process
@@ -118,6 +417,15 @@ def process_list(cursor):
         print(f"Error getting specific process from SQL: {e}")
         raise
 
+# Function to count the enabled processes
+def process_count(cursor):
+    try:
+        cursor.execute("SELECT COUNT(*) FROM processes WHERE Enabled = 1")
+        return cursor.fetchone()[0]
+    except Exception as e:
+        print(f"Error counting processes in SQL: {e}")
+        raise
+
 # Function to get a specific process
 def process_specific(cursor, proc_id):
     try:
@@ -129,41 +437,256 @@ def process_specific(cursor, proc_id):
         print(f"Error getting list of processes from SQL: {e}")
         raise
 
+# Function to check if a process has changed in Cube since its forms were last synced
+def process_changed(cursor, proc_id):
+    try:
+        query = """
+            SELECT SyncedModified IS NULL OR SyncedModified <> Modified OR SyncedForms <> Forms
+            FROM processes WHERE ProcessID = %s
+        """
+        cursor.execute(query, (proc_id,))
+        result = cursor.fetchone()
+        return bool(result[0]) if result else True
+    except Exception as e:
+        print(f"Error checking process sync status in SQL: {e}")
+        raise
+
+# Function to claim the next enabled process with forms left to export.  Processes claimed by
+# another node are skipped until their claim expires.  Rows locked by a node that is claiming at
+# the same moment are skipped too (SKIP LOCKED needs MySQL 8.0 or MariaDB 10.6).  SQLite has no
+# row locks, so the claim takes the database write lock instead.
+# Returns [ProcessID, Process, GroupID], or None when there is nothing left to claim.
+def process_claim(cursor, owner, claim_expires, now, exclude, cnx):
+    try:
+        excluded = EXCLUDE_PROCESSES.format(placeholders=_placeholders(exclude)) if exclude else ""
+        query = PROCESS_CLAIM_QUERY.format(excluded=excluded, lock=_sql(*SKIP_LOCKED))
+        cnx.commit()  # Start a fresh transaction for the locking read
+        if backend() == 'sqlite':
+            cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(query, (owner, now, *exclude))
+        row = cursor.fetchone()
+        if row is None:
+            cnx.commit()
+            return None
+
+        cursor.execute(
+            "UPDATE processes SET ClaimedBy = %s, ClaimExpires = %s WHERE ProcessID = %s",
+            (owner, claim_expires, row[0])
+        )
+        cnx.commit()
+        return list(row)
+    except Exception as e:
+        cnx.rollback()
+        print(f"Error claiming process in SQL: {e}")
+        raise
+
+# Function to claim one process for a run, so only one run at a time exports it (and writes its
+# Process.xlsx).  Returns False if another run holds an unexpired claim on it.
+def process_claim_specific(cursor, proc_id, owner, claim_expires, now, cnx):
+    try:
+        query = """
+            UPDATE processes SET ClaimedBy = %s, ClaimExpires = %s
+            WHERE ProcessID = %s AND (ClaimedBy IS NULL OR ClaimedBy = %s OR ClaimExpires < %s)
+        """
+        cursor.execute(query, (owner, claim_expires, proc_id, owner, now))
+        claimed = cursor.rowcount > 0
+        cnx.commit()
+        return claimed
+    except Exception as e:
+        cnx.rollback()
+        print(f"Error claiming process {proc_id} in SQL: {e}")
+        raise
+
+# Function to extend the process claims and form leases held by a node
+def claims_renew(cursor, owner, expires, cnx):
+    try:
+        cursor.execute(CLAIMS_RENEW_QUERY, (expires, owner))
+        cursor.execute(CLAIMS_RENEW_JOBS_QUERY, (expires, owner))
+        cnx.commit()
+    except Exception as e:
+        print(f"Error renewing claims in SQL: {e}")
+        raise
+
+# Function to give up the process claims held by a node (just proc_id's claim if it is given)
+def process_release(cursor, owner, cnx, proc_id=None):
+    try:
+        query = "UPDATE processes SET ClaimedBy = NULL, ClaimExpires = NULL WHERE ClaimedBy = %s"
+        if proc_id is None:
+            cursor.execute(query, (owner,))
+        else:
+            cursor.execute(query + " AND ProcessID = %s", (owner, proc_id))
+        cnx.commit()
+    except Exception as e:
+        print(f"Error releasing process claims in SQL: {e}")
+        raise
+
+# Function to record the Modified/Forms values a process's forms were last synced at
+def process_synced(cursor, proc_id, cnx):
+    try:
+        query = "UPDATE processes SET SyncedModified = Modified, SyncedForms = Forms WHERE ProcessID = %s"
+        cursor.execute(query, (proc_id,))
+        cnx.commit()
+    except Exception as e:
+        print(f"Error updating process sync status in SQL: {e}")
+        raise
+
 # Resets completion status of all forms in a process to 0    
 def process_reset(cursor, proc_id, cnx):
     try:
-        query = "UPDATE forms SET Completed = 0 WHERE ProcessID = %s"
-        cursor.execute(query, (proc_id,))
+        cursor.execute(PROCESS_RESET_QUERY, (proc_id,))
+        cursor.execute(PROCESS_RESET_JOBS_QUERY, (proc_id,))
         cnx.commit()  # Commit after resetting the process status
     except Exception as e:
         print(f"Error updating process status to zero: {e}")
         raise
 
-# Function to insert data into processes table
-def process_insert(cursor, proc, cnx):
+# Function to insert or update many processes in one transaction.  Enabled is only set for
+# new processes so processes disabled in SQL stay disabled.
+def process_insert_many(cursor, procs, cnx):
     try:
-        if not process_exists(cursor, proc["ProcessID"]):
-            insert_proc_query = """
-                INSERT INTO processes 
-                (ProcessID, Process, Enabled, Added, Modified, Forms, Archived, Fields, GroupID, RepeatingFields) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            proc_data = (
-                proc["ProcessID"], proc["Process"], proc["Enabled"], proc["Added"], proc["Modified"], 
+        insert_proc_query = _sql("""
+            INSERT INTO processes
+            (ProcessID, Process, Enabled, Added, Modified, Forms, Archived, Fields, GroupID, RepeatingFields)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                Process = VALUES(Process), Modified = VALUES(Modified), Forms = VALUES(Forms),
+                Archived = VALUES(Archived), Fields = VALUES(Fields), GroupID = VALUES(GroupID),
+                RepeatingFields = VALUES(RepeatingFields)
+        """, """
+            INSERT INTO processes
+            (ProcessID, Process, Enabled, Added, Modified, Forms, Archived, Fields, GroupID, RepeatingFields)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (ProcessID) DO UPDATE SET
+                Process = excluded.Process, Modified = excluded.Modified, Forms = excluded.Forms,
+                Archived = excluded.Archived, Fields = excluded.Fields, GroupID = excluded.GroupID,
+                RepeatingFields = excluded.RepeatingFields
+        """)
+        proc_data = [
+            (
+                proc["ProcessID"], proc["Process"], proc["Enabled"], proc["Added"], proc["Modified"],
                 proc["Forms"], proc["Archived"], proc["Fields"], proc["GroupID"], proc["RepeatingFields"]
             )
-            cursor.execute(insert_proc_query, proc_data)
-            cnx.commit()  # Commit after inserting
+            for proc in procs
+        ]
+        _executemany(cursor, insert_proc_query, proc_data)
+        cnx.commit()  # Commit once for the whole batch
     except Exception as e:
         print(f"Error updating process table in SQL: {e}")
         raise
 
-# Function to check if a record exists in the groups table
-def group_exists(cursor, group_id):
+# Function to get the number of API calls made on a day with an API key
+def api_usage_fetch(cursor, day, key_id):
+    try:
+        query = "SELECT Calls FROM api_usage WHERE Day = %s AND KeyID = %s"
+        cursor.execute(query, (day, key_id))
+        result = cursor.fetchone()
+        return result[0] if result else 0
+    except Exception as e:
+        print(f"Error getting API usage from SQL: {e}")
+        raise
+
+# Function to add to the number of API calls made on a day with an API key
+def api_usage_add(cursor, day, key_id, calls, cnx):
+    try:
+        query = _sql("""
+            INSERT INTO api_usage (Day, KeyID, Calls) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE Calls = Calls + VALUES(Calls)
+        """, """
+            INSERT INTO api_usage (Day, KeyID, Calls) VALUES (%s, %s, %s)
+            ON CONFLICT (Day, KeyID) DO UPDATE SET Calls = api_usage.Calls + excluded.Calls
+        """)
+        cursor.execute(query, (day, key_id, calls))
+        cnx.commit()
+    except Exception as e:
+        print(f"Error updating API usage in SQL: {e}")
+        raise
+
+# Function to get the content hash stored for a Cube FileID
+def file_hash(cursor, file_id):
+    try:
+        cursor.execute(FILE_HASH_QUERY, (file_id,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+    except Exception as e:
+        print(f"Error getting file hash from SQL: {e}")
+        raise
+
+# Function to record the content hash of a Cube FileID
+def file_insert(cursor, file_id, file_hash, size, cnx, file_name=None):
+    try:
+        query = _sql("""
+            INSERT INTO files (FileID, Hash, Size, FileName, Stored) VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE Hash = VALUES(Hash), Size = VALUES(Size),
+                FileName = VALUES(FileName), Stored = VALUES(Stored)
+        """, """
+            INSERT INTO files (FileID, Hash, Size, FileName, Stored) VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (FileID) DO UPDATE SET Hash = excluded.Hash, Size = excluded.Size,
+                FileName = excluded.FileName, Stored = excluded.Stored
+        """)
+        cursor.execute(query, (file_id, file_hash, size, file_name, datetime.now()))
+        cnx.commit()
+    except Exception as e:
+        print(f"Error adding file hash in SQL: {e}")
+        raise
+
+# Stages of a form's export, in order.  Each has a column in the jobs table.
+JOB_STAGES = ("Fetched", "JsonSaved", "Attachments", "Excel", "Html", "Pdf")
+
+# Function to claim a form for export.  A form is only claimed if nobody holds it, the lease is
+# ours, or the lease has expired.  Returns the job's stage state, or None if another run holds it.
+def job_claim(cursor, form_id, proc_id, owner, lease_expires, now, cnx):
+    try:
+        # Forms another run has completed since this run read them are never claimed again
+        cursor.execute(JOB_INSERT_QUERY.format(insert=_sql(*INSERT_IGNORE)), (proc_id, form_id))
+        cursor.execute(JOB_CLAIM_QUERY, (owner, lease_expires, form_id, owner, now))
+        claimed = cursor.rowcount > 0
+        cnx.commit()
+        if not claimed:
+            return None
+
+        cursor.execute(f"SELECT {', '.join(JOB_STAGES)}, DataPath FROM jobs WHERE Form = %s", (form_id,))
+        row = cursor.fetchone()
+        job = dict(zip(JOB_STAGES, (bool(value) for value in row[:-1])))
+        job["DataPath"] = row[-1]
+        return job
+    except Exception as e:
+        print(f"Error claiming form {form_id} in SQL: {e}")
+        raise
+
+# Function to record finished stages of a form and renew its lease
+def job_stage(cursor, form_id, stages, lease_expires, cnx, data_path=None):
+    try:
+        columns = [f"{stage} = 1" for stage in stages if stage in JOB_STAGES]
+        params = [datetime.now(), lease_expires]
+        if data_path is not None:
+            columns.append("DataPath = %s")
+            params.insert(0, data_path)
+        cursor.execute(JOB_STAGE_QUERY.format(columns=', '.join(columns)), (*params, form_id))
+        cnx.commit()
+    except Exception as e:
+        print(f"Error updating stage of form {form_id} in SQL: {e}")
+        raise
+
+# Function to record a finished stage for many forms at once
+def job_stage_many(cursor, form_ids, stage, cnx):
+    try:
+        if stage not in JOB_STAGES:
+            raise ValueError(f"Unknown job stage {stage}")
+        updated = datetime.now()
+        _executemany(
+            cursor, f"UPDATE jobs SET {stage} = 1, Updated = %s WHERE Form = %s",
+            [(updated, form_id) for form_id in form_ids]
+        )
+        cnx.commit()
+    except Exception as e:
+        print(f"Error updating job stages in SQL: {e}")
+        raise
+
+# Function to give up a run's leases so other runs can pick the forms up straight away
+def job_release(cursor, owner, cnx):
     try:
-        check_query = "SELECT COUNT(*) FROM groups WHERE ID = %s"
-        cursor.execute(check_query, (group_id,))
-        return cursor.fetchone()[0] > 0
+        cursor.execute(JOB_RELEASE_QUERY, (owner,))
+        cnx.commit()
     except Exception as e:
-        print(f"Error checking if record exists in SQL: {e}")
+        print(f"Error releasing job leases in SQL: {e}")
         raise
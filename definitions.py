@@ -0,0 +1,87 @@
+import config
+import excel
+from jinja2 import Environment
+import json
+import os
+from pathlib import Path
+import threading
+
+# Load settings file
+settings = config.load()
+
+# Configure Jinja2
+def from_json(value):
+    return json.loads(value)
+
+env = Environment()
+env.filters['from_json'] = from_json
+
+# Loaded files keyed by path, stored with the modification time they were loaded at
+_cache = {}
+_cache_lock = threading.Lock()
+
+# Function to load a file through the cache.  The file is only read again when its
+# modification time changes, so edits are picked up mid-run.  Returns None if it doesn't exist.
+def _cached(path, loader):
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with _cache_lock:
+        cached = _cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    value = loader(path)
+    with _cache_lock:
+        _cache[path] = (mtime, value)
+    return value
+
+def _read_json(path):
+    with open(path, 'r') as json_file:
+        return json.load(json_file)
+
+def _read_text(path):
+    with open(path, 'r') as text_file:
+        return text_file.read()
+
+# Function to load and compile a toc.json/report.json definition
+def _load_columns(path):
+    column_config = _read_json(path)
+    if not isinstance(column_config.get("columns"), dict):
+        raise ValueError(f"{path} must contain a \"columns\" object")
+    return excel.compile_columns(column_config)
+
+# Function to load and check an html.json definition
+def _load_html(path):
+    html_config = _read_json(path)
+    if not isinstance(html_config.get("fields_to_extract"), dict):
+        raise ValueError(f"{path} must contain a \"fields_to_extract\" object")
+    return html_config
+
+# Function to load and compile a layout.html template
+def _load_template(path):
+    return env.from_string(_read_text(path))
+
+# Function to return the definitions for a process folder.  Missing files are returned as None.
+def load(input_dir):
+    html_config = _cached(os.path.join(input_dir, "html.json"), _load_html)
+    template = _cached(os.path.join(input_dir, "layout.html"), _load_template)
+    if html_config is not None and template is None:
+        raise ValueError(f"html.json in {input_dir} needs a layout.html file")
+
+    return {
+        "toc": _cached(os.path.join(input_dir, "toc.json"), _load_columns),
+        "report": _cached(os.path.join(input_dir, "report.json"), _load_columns),
+        "html": html_config,
+        "template": template,
+    }
+
+# Function to return the stylesheet contents used for local HTML renders
+def stylesheet():
+    return _cached(os.path.join(settings['assets'], 'stylesheet.css'), _read_text) or ''
+
+# Function to return the file:// URL of the logo used for local HTML renders
+def logo_url():
+    return Path(os.path.abspath(os.path.join(settings['assets'], 'logo.png'))).as_uri()
@@ -1,7 +1,30 @@
 import pandas as pd
-from openpyxl import load_workbook
+from openpyxl import load_workbook, Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from datetime import date, datetime
+import itertools
 import json
+import metrics
 import os
+import shutil
+import threading
+import time
+
+# Rows waiting to be written (a SheetBatch), keyed by (file_path, sheet_name)
+_buffers = {}
+_waiting = {}  # Rows waiting per key, until they are written (not just taken from _buffers)
+_buffer_lock = threading.Lock()
+
+# Serialises workbook rewrites and checkpoints
+_write_lock = threading.Lock()
+
+# Workbooks with checkpointed rows that haven't been merged into the workbook yet
+_spilled = set()
+
+# Checkpoint files are named after the run, so they are merged in the order they were written
+_run = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+_sequence = itertools.count(1)
 
 # Helper function to get a nested value from a dictionary using a list of keys.
 def get_nested_value(data, keys):
@@ -12,6 +35,22 @@ def get_nested_value(data, keys):
             return ""  # If data is not a dict, return empty string
     return data if data else ""
 
+# Path of the field list inside a ProcForm response
+FIELDS_PATH = ["Result", "Form", "Fields"]
+
+# Helper function to index a form's Fields by 'Field' name and 'Uid' in one pass.  The first
+# field with a given name or Uid is kept, matching the linear scans this replaces.
+def field_index(data):
+    index = {"Field": {}, "Uid": {}}
+    fields = get_nested_value(data, FIELDS_PATH)
+    if isinstance(fields, list):
+        for field in fields:
+            if isinstance(field, dict):
+                for key, lookup in index.items():
+                    if key in field:
+                        lookup.setdefault(field[key], field)
+    return index
+
 # Helper function to flatten nested 'Rows' into a single string.
 def flatten_rows(field_data, subfield, extract):
     flattened = []
@@ -25,59 +64,374 @@ def flatten_rows(field_data, subfield, extract):
             flattened.append(", ".join(parts))
     return "; ".join(flattened) if flattened else ""
 
-def dataframe(data, form_number, json_file):
-    # Load configuration from a file
-    with open(json_file, 'r') as config_file:
-        config = json.load(config_file)
-
-    # Create a dictionary to hold the DataFrame's columns dynamically
-    df_data = {}
+# Column types a toc.json/report.json column can declare with "type" (used by the analytics export)
+COLUMN_TYPES = ("string", "int", "float", "date", "bool")
 
-    # Iterate over the configuration and dynamically populate the dictionary
+# Function to compile a toc.json/report.json definition into a list of column extractors.
+# Each entry is (column, kind, keys, field, type) so paths are only split once per definition.
+def compile_columns(config):
+    plan = []
     for column, path_config in config["columns"].items():
+        column_type = "string"
+        if isinstance(path_config, dict) and "path" in path_config:
+            column_type = path_config.get("type", "string")
+            if column_type not in COLUMN_TYPES:
+                raise ValueError(f"Column \"{column}\" has unknown type \"{column_type}\" (use one of {', '.join(COLUMN_TYPES)})")
+
+        # If we have a simple "path", handle it by splitting and retrieving the value.
+        if isinstance(path_config, dict) and "path" in path_config and "field" not in path_config:
+            plan.append((column, "path", path_config["path"].split('.'), None, column_type))
+
+        # If we have both "path" and "field", this means we're looking in the "Fields" array.
+        # The form's own field list is resolved through field_index instead of a scan.
+        elif isinstance(path_config, dict) and "path" in path_config and "field" in path_config:
+            keys = path_config["path"].split('.')
+            kind = "indexed" if keys == FIELDS_PATH else "field"
+            plan.append((column, kind, keys, path_config["field"], column_type))
+
+        else:
+            # Static value or direct form_number
+            plan.append((column, "static", None, path_config, column_type))
+    return plan
+
+# Function to return the column of a plan that holds the form number (Result.Form.Number or a
+# "form_number" static column), or None if it has none
+def number_column(columns):
+    for column, kind, keys, field_name, _ in columns:
+        if (kind == "path" and keys == ["Result", "Form", "Number"]) or (kind == "static" and field_name == "form_number"):
+            return column
+    return None
+
+# Function to return the column names of a plan from compile_columns, in order
+def header(columns):
+    return tuple(entry[0] for entry in columns)
+
+# Function to return the declared types of a plan's columns, in order
+def column_types(columns):
+    return tuple(entry[4] for entry in columns)
+
+# Function to extract a form's row as a tuple of values in the order of the plan's columns.
+# columns is a plan from compile_columns.  index is the form's field_index, built here if not given.
+def row(data, form_number, columns, index=None):
+    values = []
+
+    # Run each column extractor against the form
+    for column, kind, keys, field_name, _ in columns:
         try:
-            # If we have a simple "path", handle it by splitting and retrieving the value.
-            if isinstance(path_config, dict) and "path" in path_config and "field" not in path_config:
-                keys = path_config["path"].split('.')
+            if kind == "path":
                 # Extract the nested value using the keys
-                df_data[column] = [get_nested_value(data, keys)]
-            
-            # If we have both "path" and "field", this means we're looking in the "Fields" array.
-            elif isinstance(path_config, dict) and "path" in path_config and "field" in path_config:
-                keys = path_config["path"].split('.')
+                values.append(get_nested_value(data, keys))
+
+            elif kind == "indexed":
+                if index is None:
+                    index = field_index(data)
+                field = index["Field"].get(field_name)
+                values.append(field["Value"] if field is not None else "")
+
+            elif kind == "field":
                 fields_data = get_nested_value(data, keys)
-                field_name = path_config["field"]
                 # Find the field by name and extract its value
-                df_data[column] = [next((item["Value"] for item in fields_data if item["Field"] == field_name), "")]
-            
+                values.append(next((item["Value"] for item in fields_data if item["Field"] == field_name), ""))
+
             else:
                 # Static value or direct form_number
-                df_data[column] = [form_number] if path_config == "form_number" else [path_config]
+                values.append(form_number if field_name == "form_number" else field_name)
 
         except KeyError:
-            df_data[column] = [""]  # Handle missing fields with an empty string
+            values.append("")  # Handle missing fields with an empty string
+
+    return tuple(values)
+
+# Rows for one sheet, stored column by column.  Forms add their row tuples as they finish, and the
+# sheet is only turned into an Arrow table (if at all) once, when it is written.
+class SheetBatch:
+    def __init__(self):
+        self.header = []
+        self.columns = []
+        self.keys = []
+        self.length = 0
+        self.number_column = None  # Column identifying each form's row (see number_column())
+        self._positions = {}
+
+    def __len__(self):
+        return self.length
+
+    # Function to add rows with the given column names.  Columns not seen before are added at the
+    # end, and cells a row has no column for are left empty (None).
+    def add(self, header, rows, key=None):
+        positions = []
+        for column in header:
+            position = self._positions.get(column)
+            if position is None:
+                position = self._positions[column] = len(self.header)
+                self.header.append(column)
+                self.columns.append([None] * self.length)
+            positions.append(position)
+
+        for values in rows:
+            for position, value in zip(positions, values):
+                self.columns[position].append(value)
+            self.length += 1
+            for column in self.columns:
+                if len(column) < self.length:
+                    column.append(None)
+
+        if key is not None:
+            self.keys.append(key)
+
+    # Function to return the rows as tuples in header order
+    def rows(self):
+        return zip(*self.columns)
+
+    # Function to return the rows as a pyarrow Table (pip install pyarrow).  schema sets the column types.
+    def arrow(self, schema=None):
+        import pyarrow
+        return pyarrow.table(dict(zip(self.header, self.columns)), schema=schema)
+
+# Function to queue a row for a sheet.  rows is a (header, row) pair from header() and row().
+# key (eg. the FormID) is handed back by flush() once the rows are written.
+# number_column names the column identifying each form, so a form exported again replaces its row.
+# Returns the number of rows waiting for file_path.
+def buffer(file_path, rows, sheet_name='Sheet1', key=None, number_column=None):
+    columns, values = rows[0], [rows[1]]
 
-    # Create and return the DataFrame
-    df = pd.DataFrame(df_data)
-    return df
+    with _buffer_lock:
+        batch = _buffers.setdefault((file_path, sheet_name), SheetBatch())
+        batch.add(columns, values, key)
+        batch.number_column = number_column or batch.number_column
+        if key is not None:
+            _waiting[key] = _waiting.get(key, 0) + 1
+        return sum(len(batch) for (path, _), batch in _buffers.items() if path == file_path)
 
-# Function to append data to an Excel file or create a new one if it doesn't exist
-def append(file_path, df, sheet_name='Sheet1'):
-    # Check if the file already exists
+# Function to check if rows queued with key are still waiting to be written
+def is_buffered(key):
+    with _buffer_lock:
+        return key in _waiting
+
+# Function to return the keys of the rows still waiting to be written
+def buffered_keys():
+    with _buffer_lock:
+        return set(_waiting)
+
+# Function to take the buffered rows of a workbook (all workbooks if file_path is None),
+# as {file_path: {sheet_name: SheetBatch}}
+def _take(file_path):
+    with _buffer_lock:
+        keys = [key for key in _buffers if file_path is None or key[0] == file_path]
+        pending = {key: _buffers.pop(key) for key in keys}
+
+    workbooks = {}
+    for (path, sheet_name), batch in pending.items():
+        workbooks.setdefault(path, {})[sheet_name] = batch
+    return workbooks
+
+# Function to stop tracking the rows in {file_path: {sheet_name: SheetBatch}} once they are written.
+# Returns their keys.
+def _release(workbooks):
+    keys = [key for sheets in workbooks.values() for batch in sheets.values() for key in batch.keys]
+    with _buffer_lock:
+        for key in keys:
+            _waiting[key] -= 1
+            if not _waiting[key]:
+                del _waiting[key]
+    return list(set(keys))
+
+# Folder holding a workbook's checkpointed rows, and the name it is moved to while they are merged
+def _spill_folder(file_path):
+    folder, name = os.path.split(file_path)
+    return os.path.join(folder, f".{name}.rows")
+
+def _merged_folder(file_path):
+    folder, name = os.path.split(file_path)
+    return os.path.join(folder, f".{name}.merged")
+
+# Functions to save checkpointed cell values as JSON.  Dates are saved as {"date": "<ISO date>"}
+# so they are still dates in the workbook, and anything else JSON can't hold as its text.
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return {"date": value.isoformat()}
+    return str(value)
+
+def _json_date(item):
+    if len(item) == 1 and "date" in item:
+        return datetime.fromisoformat(item["date"])
+    return item
+
+# Function to checkpoint a workbook's buffered rows without rewriting it.  The rows are saved to a
+# new JSON Lines file (one line per sheet) in a hidden folder next to the workbook, and merged into
+# it once by flush().  Returns the keys of the rows that were saved.
+def spill(file_path):
+    workbooks = _take(file_path)
+    with _write_lock:
+        for path, sheets in workbooks.items():
+            with metrics.timer("excel_spill"):
+                folder = _spill_folder(path)
+                os.makedirs(folder, exist_ok=True)
+                part = f"part-{_run}-{next(_sequence):05d}.jsonl"
+
+                # Write under a temporary name first so a crash never leaves a half-written file
+                temp_path = os.path.join(folder, f".{part}.tmp")
+                with open(temp_path, 'w', encoding='utf-8') as part_file:
+                    for sheet_name, batch in sheets.items():
+                        rows = [[_cell_value(value) for value in values] for values in batch.rows()]
+                        line = {"Sheet": sheet_name, "Header": batch.header, "Rows": rows, "NumberColumn": batch.number_column}
+                        part_file.write(json.dumps(line, default=_json_value) + '\n')
+                os.replace(temp_path, os.path.join(folder, part))
+                _spilled.add(path)
+
+    return _release(workbooks)
+
+# Function to load the checkpointed rows of a workbook, in the order they were written, as {sheet_name: SheetBatch}
+def _load_spilled(folder):
+    sheets = {}
+    for part in sorted(os.listdir(folder)):
+        if not part.endswith('.jsonl'):
+            continue  # Left behind by a crash while a checkpoint was being written
+        with open(os.path.join(folder, part), 'r', encoding='utf-8') as part_file:
+            for line in part_file:
+                line = json.loads(line, object_hook=_json_date)
+                batch = sheets.setdefault(line["Sheet"], SheetBatch())
+                batch.add(line["Header"], line["Rows"])
+                batch.number_column = line.get("NumberColumn") or batch.number_column
+    return sheets
+
+# Function to write buffered and checkpointed rows to their workbooks (all workbooks if file_path
+# is None), so each workbook is rewritten once however many checkpoints it had.
+# Returns the keys of the buffered rows that were written.
+def flush(file_path=None):
+    workbooks = _take(file_path)
+
+    with _write_lock:
+        paths = set(workbooks) | {path for path in _spilled if file_path is None or path == file_path}
+        for path in paths:
+            with metrics.timer("excel_write"):
+                sheets = {}
+                folder = _spill_folder(path)
+                if os.path.isdir(folder):
+                    sheets = _load_spilled(folder)
+                for sheet_name, batch in workbooks.get(path, {}).items():
+                    sheet = sheets.setdefault(sheet_name, SheetBatch())
+                    sheet.add(batch.header, batch.rows())
+                    sheet.number_column = batch.number_column or sheet.number_column
+                _write(path, sheets, folder if os.path.isdir(folder) else None)
+            _spilled.discard(path)
+
+    return _release(workbooks)
+
+# Function to finish a merge a crashed run left half done, and queue checkpointed rows a crashed run
+# left behind to be merged by the next flush().  Returns True if there are checkpointed rows.
+def recover(file_path):
+    with _write_lock:
+        temp_path = file_path + '.tmp'
+        merged = _merged_folder(file_path)
+        if os.path.isdir(merged):
+            # The rows were merged into the temporary workbook before the crash
+            if os.path.exists(temp_path):
+                os.replace(temp_path, file_path)
+            shutil.rmtree(merged)
+        elif os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        if os.path.isdir(_spill_folder(file_path)):
+            _spilled.add(file_path)
+            return True
+        return False
+
+# Function to check if a workbook has checkpointed rows that haven't been merged into it yet
+def pending(file_path):
+    return os.path.isdir(_spill_folder(file_path)) or os.path.isdir(_merged_folder(file_path))
+
+# Function to delete a workbook and its checkpointed rows, so it is rebuilt from scratch
+def remove(file_path):
+    with _write_lock:
+        for path in (file_path, file_path + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+        for folder in (_spill_folder(file_path), _merged_folder(file_path)):
+            shutil.rmtree(folder, ignore_errors=True)
+        _spilled.discard(file_path)
+
+# Function to convert a value to something openpyxl can store in a cell
+def _cell_value(value):
+    if isinstance(value, (list, dict, tuple, set)):
+        return str(value)
+    if hasattr(value, 'item'):
+        value = value.item()  # numpy scalars
+    try:
+        if pd.isna(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+    return value
+
+# Function to keep only the last row of each form number in a sheet's rows, in their order.
+# Rows without a form number are all kept.
+def _latest_rows(body, position):
+    latest = {}
+    for index, row in enumerate(body):
+        number = row[position] if position < len(row) else None
+        if number not in (None, ""):
+            latest[str(number)] = index
+
+    kept = []
+    for index, row in enumerate(body):
+        number = row[position] if position < len(row) else None
+        if number in (None, "") or latest[str(number)] == index:
+            kept.append(row)
+    return kept
+
+# Function to rewrite a workbook once with its existing rows plus the new rows for each sheet,
+# using openpyxl's streaming write-only mode.  spill_folder holds the checkpointed rows included
+# in new_sheets, and is deleted once they are in the workbook.
+def _write(file_path, new_sheets, spill_folder=None):
+    # Read the existing sheets (header row first)
+    existing = {}
     if os.path.exists(file_path):
-        # Load the existing Excel workbook
-        with pd.ExcelWriter(file_path, engine='openpyxl', mode='a', if_sheet_exists='overlay') as writer:
-            # Try to load the existing data from the specified sheet
-            try:
-                existing_df = pd.read_excel(file_path, sheet_name=sheet_name)
-                # Append the new data to the existing data
-                combined_df = pd.concat([existing_df, df], ignore_index=True)
-                # Write the updated DataFrame back to the sheet
-                combined_df.to_excel(writer, sheet_name=sheet_name, index=False)
-            except ValueError:
-                # If the sheet does not exist, simply create it
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
-    else:
-        # If the file does not exist, create a new one with the new data
-        with pd.ExcelWriter(file_path, engine='openpyxl', mode='w') as writer:
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
\ No newline at end of file
+        workbook = load_workbook(file_path, read_only=True)
+        for worksheet in workbook.worksheets:
+            existing[worksheet.title] = [list(row) for row in worksheet.iter_rows(values_only=True)]
+        workbook.close()
+
+    workbook = Workbook(write_only=True)
+    sheet_names = list(existing) + [name for name in new_sheets if name not in existing]
+    for sheet_name in sheet_names:
+        rows = existing.get(sheet_name, [])
+        header = list(rows[0]) if rows else []
+        body = rows[1:]
+
+        batch = new_sheets.get(sheet_name)
+        if batch is not None:
+            # Line the new rows up with the existing header, adding any new columns at the end
+            header += [column for column in batch.header if column not in header]
+            positions = [header.index(column) for column in batch.header]
+            for values in batch.rows():
+                row = [None] * len(header)
+                for position, value in zip(positions, values):
+                    row[position] = _cell_value(value)
+                body.append(row)
+
+            # A form exported again (eg. after it was edited in Cube) replaces its earlier row
+            if batch.number_column is not None:
+                body = _latest_rows(body, header.index(batch.number_column))
+
+        worksheet = workbook.create_sheet(sheet_name)
+        header_cells = []
+        for column in header:
+            cell = WriteOnlyCell(worksheet, value=column)
+            cell.font = Font(bold=True)
+            header_cells.append(cell)
+        worksheet.append(header_cells)
+        for row in body:
+            worksheet.append(row)
+
+    # Save to a temporary file first so a crash never leaves a half-written workbook.  The
+    # checkpointed rows are renamed before the workbook is replaced, so recover() can tell
+    # whether they are already in the saved workbook.
+    temp_path = file_path + '.tmp'
+    workbook.save(temp_path)
+    if spill_folder is not None:
+        merged = _merged_folder(file_path)
+        os.replace(spill_folder, merged)
+    os.replace(temp_path, file_path)
+    if spill_folder is not None:
+        shutil.rmtree(merged)
@@ -1,41 +1,36 @@
+import analytics
 import api
+import archive
 import argparse
+import async_engine
+import attachments
+import asyncio
+import completions
 import config
 import database
-from datetime import datetime
+import definitions
+from datetime import datetime, timedelta
 import excel
+import functools
 import glob
-from jinja2 import Template, Environment
-import json
 import logging
+import metrics
 import os
-from pathlib import Path
-import pdfkit
-import re
-import requests
+import pdf
+import render
+import socket
 import sys
+import time
 from time import sleep
-from urllib.parse import urljoin
 
 # Import threading modules
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import threading
 from tqdm import tqdm  # For progress bar (install via pip if not available)
 
 # Load settings file
 settings = config.load()
 
-# Configure Jinja2
-def from_json(value):
-    return json.loads(value)
-
-env = Environment()
-env.filters['from_json'] = from_json
-
-# Configure PDF writer
-path_wkhtmltopdf = settings['wkhtmltopdf']
-pdfkit_config = pdfkit.configuration(wkhtmltopdf=path_wkhtmltopdf)
-
 # Lists to store skipped items
 skipped_processes = []
 skipped_downloads = []
@@ -44,48 +39,52 @@ skipped_forms = []
 # Threading lock for shared resources
 lock = threading.Lock()
 
-# Thread-local storage for database connections
-thread_local = threading.local()
-
 # Event to signal when API limit is reached
 api_limit_reached = threading.Event()
 
+# Name this run uses to lease forms in the jobs table
+run_owner = f"{socket.gethostname()}-{os.getpid()}"
+
+# Forms that are finished apart from Excel or analytics rows still waiting to be written
+awaiting_excel = set()
+excel_lock = threading.Lock()
+
+# Forms with Excel rows written whose Excel stage waits on their analytics rows (both are redone
+# together when a form is resumed, so the stage is only recorded once both are written)
+awaiting_stage = set()
+
 # Function to handle groups data
 def sync_groups(cursor, url, cnx):
     global settings
     
     data = api.fetch_data(url, settings)
+    if data.get("Result", {}).get("Error", {}).get("Message") == api.LIMIT_MESSAGE:
+        print(f"    {api.LIMIT_MESSAGE}. Skipping group sync...")
+        return
     if "Result" not in data or "Groups" not in data["Result"]:
         raise ValueError("Invalid response structure for groups")
     groups = data["Result"]["Groups"]
-    total_groups = len(groups)
 
-    for i, group in enumerate(groups):
-        database.group_insert(cursor, group, cnx)  # Pass cnx for committing transactions
-        completion_percentage = ((i + 1) / total_groups) * 100
-        sys.stdout.write(f"\r    Groups: {completion_percentage:.2f}%")
-        sys.stdout.flush()
-    print()  # Move to the next line after completion
+    database.group_insert_many(cursor, groups, cnx)  # Pass cnx for committing transactions
+    print(f"    Groups: {len(groups)} synced")
 
 # Function to handle processes data
 def sync_processes(cursor, url, cnx):
     global settings
     
     data = api.fetch_data(url, settings)
+    if data.get("Result", {}).get("Error", {}).get("Message") == api.LIMIT_MESSAGE:
+        print(f"    {api.LIMIT_MESSAGE}. Skipping process sync...")
+        return
     if "Result" not in data or "Procs" not in data["Result"]:
         raise ValueError("Invalid response structure for processes")
     procs = data["Result"]["Procs"]
-    total_procs = len(procs)
-
-    for i, proc in enumerate(procs):
-        database.process_insert(cursor, proc, cnx)  # Pass cnx for committing transactions
-        completion_percentage = ((i + 1) / total_procs) * 100
-        sys.stdout.write(f"\r    Processes: {completion_percentage:.2f}%")
-        sys.stdout.flush()
-    print()  # Move to the next line after completion
+
+    database.process_insert_many(cursor, procs, cnx)  # Pass cnx for committing transactions
+    print(f"    Processes: {len(procs)} synced")
     
 # Function to handle forms data
-def sync_forms(cursor, url, cnx, proc_id="0"):
+def sync_forms(cursor, url, cnx, proc_id="0", incremental=False):
     global skipped_processes
     
     # If --sync specific process is called, run this
@@ -103,7 +102,11 @@ def sync_forms(cursor, url, cnx, proc_id="0"):
         enabled = database.process_status(cursor, x[0])
         
         # Check if process is enabled in SQL.  This feature can be used to temporarily skip syncing big processes.
-        if enabled:
+        if enabled and incremental and not database.process_changed(cursor, x[0]):
+            # Nothing has changed in Cube since the last sync of this process
+            sys.stdout.write(f"\r      ({processes_current} of {processes_total}) {x[1]}: UNCHANGED")
+            sys.stdout.flush()
+        elif enabled:
             # Fetch forms data for each ProcessID
             forms_data = api.fetch_data(url, {"ProcessID": x[0]})
             
@@ -113,6 +116,9 @@ def sync_forms(cursor, url, cnx, proc_id="0"):
                 if error_message == "Process is archived":
                     print(f"Process {x[1]} is archived. Skipping...")
                     continue
+                elif error_message == api.LIMIT_MESSAGE:
+                    print(f"{error_message}. Stopping form sync...")
+                    return
                 elif error_message == "User lacks permission to Read forms of the template":
                     print(f"Process {x[1]} lacks permission. Skipping...")
                     skipped_processes.append(x[0])
@@ -123,22 +129,12 @@ def sync_forms(cursor, url, cnx, proc_id="0"):
             
             # Extract forms data
             forms = forms_data["Result"]["Forms"]
-            total_forms = len(forms)
-            
-            if not forms:
-                # No forms for this process, report 100% completion
-                sys.stdout.write(f"\r      ({processes_current} of {processes_total}) {x[1]}: 100%")
-                sys.stdout.flush()
-            else:
-                # Process each form
-                for j, form in enumerate(forms):
-                    # Insert form into the database
-                    database.form_insert(cursor, x[0], form, cnx)
-                    
-                    # Calculate completion percentage for the current process
-                    form_completion_percentage = ((j + 1) / total_forms) * 100
-                    sys.stdout.write(f"\r      ({processes_current} of {processes_total}) {x[1]}: {form_completion_percentage:.2f}%")
-                    sys.stdout.flush()
+
+            # Add new forms to the database in one batch
+            added = database.form_insert_many(cursor, x[0], forms, cnx)
+            database.process_synced(cursor, x[0], cnx)
+            sys.stdout.write(f"\r      ({processes_current} of {processes_total}) {x[1]}: {len(forms)} forms, {added} new or changed")
+            sys.stdout.flush()
         else:
             sys.stdout.write(f"\r      ({processes_current} of {processes_total}): SKIPPED")
             sys.stdout.flush()
@@ -149,319 +145,554 @@ def sync_forms(cursor, url, cnx, proc_id="0"):
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-def extract_field(data, field_def):
-    # Navigate through the path defined in field_def["path"]
-    parts = field_def.get("path", "").split('.')
-    for part in parts:
-        if isinstance(data, dict) and part in data:
-            data = data[part]
-        else:
-            logging.warning(f"Path '{'.'.join(parts)}' not found in data.")
-            return None  # Handle missing paths gracefully
-
-    # Determine the key to match on ('Field' or 'Uid')
-    match_on = field_def.get('match_on', 'Field')
-
-    # If there's a specific field to extract, handle it
-    if "field" in field_def:
-        # Ensure that 'data' is a list or collection of fields
-        if isinstance(data, list):
-            for field in data:
-                # Check if the current item in the list is a dictionary with the matching key
-                if isinstance(field, dict) and match_on in field:
-                    if field[match_on] == field_def['field']:
-                        # If there is a 'subfield', we need to drill down further
-                        if "subfield" in field_def:
-                            subfield_data = field.get(field_def['subfield'], [])
-                            if subfield_data:
-                                # Handle the 'extract' definitions
-                                if "extract" in field_def:
-                                    extracted_items = []
-                                    for item in subfield_data:
-                                        item_data = {}
-                                        for subfield_name, subfield_def in field_def['extract'].items():
-                                            # For nested paths in subfields, adjust the path
-                                            subfield_def_relative = subfield_def.copy()
-                                            subfield_def_relative['path'] = subfield_def.get('path', '')
-                                            value = extract_field(item, subfield_def_relative)
-                                            item_data[subfield_name] = value
-                                        extracted_items.append(item_data)
-                                    return extracted_items
-                                else:
-                                    return subfield_data
-                            else:
-                                logging.info(f"No data found for subfield '{field_def['subfield']}' in field '{field_def['field']}'.")
-                                return []
-                        else:
-                            # Extract the 'Value' or 'Values' from the field
-                            return extract_value(field, field_def)
-            # If we didn't find the field, return None
-            logging.warning(f"Field '{field_def['field']}' not found in data.")
-            return None
-        else:
-            logging.warning(f"Expected a list for field '{field_def['field']}' but got {type(data)}")
-            return None
-    else:
-        # If no 'field' key, return data
-        return data
-
-def extract_value(field, field_def):
-    value = None
-    if 'Value' in field:
-        value = field['Value']
-    elif 'Values' in field and field['Values']:
-        # Extract all values and join them if necessary
-        values = [v.get('Value', '') for v in field['Values']]
-        value = ', '.join(values)
-    else:
-        value = None
+# Function to mark a form as completed in the database.  Forms with Excel or analytics rows still
+# waiting to be written are completed by flush_excel or flush_analytics once their rows are written.
+def complete_form(form_id):
+    with metrics.locked(excel_lock, "excel"):
+        if excel.is_buffered(form_id) or analytics.is_buffered(form_id):
+            awaiting_excel.add(form_id)
+            return
+
+    completions.complete(form_id)
+
+# Function to write buffered Excel rows, record the Excel stage of the forms with no Excel or
+# analytics rows left to write and complete the forms that were only waiting on their rows.  With file_path that workbook's rows
+# are checkpointed, otherwise every workbook and every analytics dataset is written.  Rows stay
+# buffered until they are written, so excel_lock is only needed to take the finished forms.
+def flush_excel(file_path=None):
+    written = excel.spill(file_path) if file_path else excel.flush()
+    if file_path is None:
+        analytics.flush()
+    with metrics.locked(excel_lock, "excel"):
+        staged = staged_forms(written)
+        finished = finished_forms()
+
+    record_excel(staged)
+    complete_many(finished)
+
+# Function to write a process's buffered analytics rows and complete the forms that were only waiting on them
+def flush_analytics(output_dir):
+    analytics.flush(output_dir)
+    with metrics.locked(excel_lock, "excel"):
+        staged = staged_forms()
+        finished = finished_forms()
+
+    record_excel(staged)
+    complete_many(finished)
+
+# Function to take the forms whose Excel rows were just written (written) or written earlier, and
+# whose analytics rows have been written too.  Called with excel_lock held.
+def staged_forms(written=()):
+    awaiting_stage.update(written)
+    staged = awaiting_stage.difference(excel.buffered_keys(), analytics.buffered_keys())
+    awaiting_stage.difference_update(staged)
+    return staged
+
+# Function to record the Excel stage of forms in one transaction
+def record_excel(staged):
+    if staged:
+        cnx, cursor = database.thread_setup()
+        database.job_stage_many(cursor, list(staged), "Excel", cnx)
+
+# Function to take the waiting forms whose Excel and analytics rows have all been written.
+# Called with excel_lock held.
+def finished_forms():
+    finished = awaiting_excel.difference(excel.buffered_keys(), analytics.buffered_keys())
+    awaiting_excel.difference_update(finished)
+    return finished
+
+# Function to mark forms completed in the database in one transaction
+def complete_many(finished):
+    if finished:
+        cnx, cursor = database.thread_setup()
+        with metrics.timer("db_complete_many"):
+            database.form_complete_many(cursor, finished, cnx)
+        metrics.count("forms_completed", len(finished))
+
+# Function to return when a lease taken or renewed now expires
+def lease_expiry():
+    return datetime.now() + timedelta(seconds=settings.get('job_lease_seconds', 600))
+
+# Function to return the export folder of a process
+def process_folder(process_name, x):
+    return os.path.join(settings['files'], process_name, x[1].replace('/', '').replace('"', '').strip())
+
+# Function to check if definition files have been added to a process since it was exported, so
+# every one of its forms needs exporting again
+def definitions_added(input_dir, output_dir):
+    if not os.path.exists(input_dir) or excel.pending(os.path.join(output_dir, 'Process.xlsx')):
+        return False
+    return not glob.glob(os.path.join(output_dir, '*.xlsx'))
+
+# Function to clear the completed status of a process's forms, and its analytics dataset, as every form is exported again
+def reset_process(cursor, x, output_dir, cnx):
+    database.process_reset(cursor, x[0], cnx)
+    analytics.reset(output_dir)
+    print(f"    Definitions have been added to {x[1]}, resetting form statuses")
+
+# Function to reset the processes with newly added definition files before claiming starts (--shard).
+# A process that was fully exported has no forms left to claim, so it would otherwise never be reset.
+# Returns the ProcessIDs that were reset.
+def reset_added_definitions(cursor, processes, cnx):
+    reset = set()
+    for x in processes:
+        input_dir = os.path.join(os.getcwd(), str(x[0]))
+        output_dir = process_folder(database.group_name(cursor, x[2]), x)
+        if not definitions_added(input_dir, output_dir):
+            continue
 
-    # Parse JSON if needed
-    if field_def.get('parse_json') and value:
+        # Hold the claim while resetting, so a process another node is exporting isn't reset under it
+        if database.process_claim_specific(cursor, x[0], run_owner, lease_expiry(), datetime.now(), cnx):
+            reset_process(cursor, x, output_dir, cnx)
+            database.process_release(cursor, run_owner, cnx, x[0])
+            reset.add(x[0])
+    return reset
+
+# Generator yielding processes claimed from the shared catalogue one at a time (--shard)
+def claimed_processes(cursor, cnx):
+    claimed = []
+    while not api_limit_reached.is_set():
+        x = database.process_claim(cursor, run_owner, lease_expiry(), datetime.now(), claimed, cnx)
+        if x is None:
+            return
+        claimed.append(x[0])
+        yield x
+
+# Function to keep this node's process claims and form leases alive while it runs
+def renew_claims(stop):
+    cnx = database.setup()
+    cursor = cnx.cursor()
+    interval = settings.get('job_lease_seconds', 600) / 3
+    while not stop.wait(interval):
         try:
-            value = json.loads(value)
-        except json.JSONDecodeError as e:
-            logging.warning(f"Could not parse JSON value: {e}")
-            value = None
+            database.claims_renew(cursor, run_owner, lease_expiry(), cnx)
+        except Exception:
+            pass  # Already reported by database.claims_renew, try again next time
+    cursor.close()
+    cnx.close()
 
-    # Convert to appropriate type if specified
-    if value is not None and 'type' in field_def:
-        value = convert_type(value, field_def['type'])
+# Function to claim a form in the jobs table.  Returns its stage state, or None if another run holds it
+def claim_form(form_id, proc_id):
+    cnx, cursor = database.thread_setup()
+    return database.job_claim(cursor, form_id, proc_id, run_owner, lease_expiry(), datetime.now(), cnx)
 
-    return value
+# Function to record finished stages of a form
+def mark_stage(form_id, *stages, data_path=None):
+    cnx, cursor = database.thread_setup()
+    database.job_stage(cursor, form_id, stages, lease_expiry(), cnx, data_path)
 
-def convert_type(value, type_str):
-    try:
-        if type_str == 'int':
-            return int(value)
-        elif type_str == 'float':
-            return float(value)
-        elif type_str == 'date':
-            # Adjust the date format as needed
-            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
-    except (ValueError, TypeError) as e:
-        logging.warning(f"Could not convert value '{value}' to type '{type_str}': {e}")
-        return value  # Return the original value if conversion fails
-
-    return value
-
-def extract_data(data, html_json):
-    extracted = {}
-    for field_name, field_def in html_json['fields_to_extract'].items():
-        extracted[field_name] = extract_field(data, field_def)
-    return extracted
- 
-def path_to_file_url(path):
-    return Path(path).as_uri()
-
-def download_file(url, dest_folder, file_name):
-    # Remove invalid characters from file_name
-    valid_file_name = re.sub(r'[<>:"/\\|?*]', '', file_name)
-
-    response = requests.get(url)
-    if response.status_code == 200:
-        try:
-            file_path = os.path.join(dest_folder, valid_file_name)
-            with open(file_path, 'wb') as file:
-                file.write(response.content)
-            return file_path
-        except Exception as e:
-            print()
-            print(f"    WARNING: Unable to open file: {file_path}")
-            print()
-    else:
-        return 0
+# Function to load the response saved by an earlier run, so resuming a form doesn't use an API call
+def load_saved(job):
+    if job and job["JsonSaved"] and job["DataPath"]:
+        return archive.load(job["DataPath"])
+    return None
+
+# Function to return the cleaned form number and export folder for a form
+def form_location(data, output_dir):
+    form_number = data["Result"]["Form"]["Number"].replace('/', '').replace('"', '').strip()
+    return form_number, os.path.join(output_dir, form_number)
 
 def process_single_form(form_id, input_dir, output_dir, x, process_name, max_form, args):
-    global skipped_forms, skipped_downloads
+    global skipped_forms
+    form_start = time.perf_counter()
     try:
         # Check if API limit has been reached
         if api_limit_reached.is_set():
             return False  # Stop processing
 
-        # Get or create the thread's database connection and cursor
-        if not hasattr(thread_local, 'cnx'):
-            thread_local.cnx = database.setup()
-            thread_local.cursor = thread_local.cnx.cursor()
-        cnx = thread_local.cnx
-        cursor = thread_local.cursor
-
-        # Get the form data from Cube
-        data = api.fetch_form(form_id)
-
-        # Error handling
-        error_message = data.get("Result", {}).get("Error", {}).get("Message")
-        if error_message:
-            if error_message == "API daily limit reached":
-                with lock:
-                    print(f"\n        ERROR: {error_message}. FormID: {form_id}")
-                    api_limit_reached.set()  # Set the event to signal other threads
-                return False  # Stop processing this form
-            else:
-                with lock:
-                    print(f"\n        WARNING: {error_message}. FormID: {form_id}")
-                    skipped_forms.append(form_id)
-                return False  # Skip this form but continue processing others
+        # Claim the form so other runs sharing the queue leave it alone
+        job = claim_form(form_id, x[0])
+        if job is None:
+            return False
+
+        # Resume from the response saved by an earlier run if there is one
+        data = load_saved(job)
+        if data is None:
+            # Stop starting new forms before the daily budget runs out
+            if not api.quota_available():
+                api_limit_reached.set()
+                return False
+
+            # Get the form data from Cube
+            data = api.fetch_form(form_id)
+
+        result = export_form(form_id, data, input_dir, output_dir, x, process_name, max_form, args, job=job)
+        metrics.observe("form", time.perf_counter() - form_start)
+        return result
+
+    except api.LimitReached as e:
+        # The form is left unfinished, so its attachments are fetched on a later run
+        with metrics.locked(lock):
+            print(f"\n        ERROR: {e}. FormID: {form_id}")
+            api_limit_reached.set()
+        return False
+
+    except Exception as e:
+        with metrics.locked(lock):
+            print(f"\n        ERROR processing form {form_id}: {e}")
+            skipped_forms.append(form_id)
+        return False  # Indicate failure
+
+# Function to save, render and complete a form that has already been fetched from Cube.
+# Attachments are skipped when download is False (the async engine downloads them itself).
+# job is the form's stage state from claim_form; stages an earlier run finished are skipped.
+# saved is True when data was loaded from an earlier export, so the response isn't saved again.
+# rerender is True for --rerender, which rebuilds the outputs only: no stages are recorded and the
+# form's completed status is left as it is.
+def export_form(form_id, data, input_dir, output_dir, x, process_name, max_form, args, download=True, job=None, saved=False, rerender=False):
+    global skipped_forms, skipped_downloads
+
+    done = job or dict.fromkeys(database.JOB_STAGES, False)
+    if rerender:
+        job = None  # Stages are only recorded by exports
+
+    # Error handling
+    error_message = data.get("Result", {}).get("Error", {}).get("Message")
+    if error_message:
+        if error_message == api.LIMIT_MESSAGE:
+            with metrics.locked(lock):
+                print(f"\n        ERROR: {error_message}. FormID: {form_id}")
+                api_limit_reached.set()  # Set the event to signal other threads
+            api.quota_exhausted()  # Don't spend any more calls today
+            return False  # Stop processing this form
         else:
-            # Proceed with processing
-            started_datetime = datetime.strptime(
-                data["Result"]["Form"]["Started"], "%Y-%m-%d %H:%M:%S"
+            with metrics.locked(lock):
+                print(f"\n        WARNING: {error_message}. FormID: {form_id}")
+                skipped_forms.append(form_id)
+            return False  # Skip this form but continue processing others
+    else:
+        # Proceed with processing
+        started_datetime = datetime.strptime(
+            data["Result"]["Form"]["Started"], "%Y-%m-%d %H:%M:%S"
+        )
+        year = started_datetime.year
+        month = started_datetime.month
+
+        # Determine sheet name
+        if max_form > 5000:
+            sheet = f"{year}-{month}"
+        else:
+            sheet = str(year)
+
+        form_number, form_dir = form_location(data, output_dir)
+
+        # Work out which artefacts this form still needs
+        process_definitions = definitions.load(input_dir)
+        stages = set()
+        if not done["JsonSaved"] and not saved:
+            stages.add("json")
+        if (process_definitions["toc"] is not None or process_definitions["report"] is not None) and not done["Excel"]:
+            stages.add("excel")
+        if process_definitions["html"] is not None and not done["Pdf"]:
+            stages.add("html")
+        cloud_path = None if args.nocloud else f'{process_name}/{x[1]}/{form_number}/'
+
+        # Save JSON response, to its own file or to the process's archive
+        def save_json(payload=None):
+            with metrics.timer("save_json"):
+                data_path = archive.save(data, output_dir, form_dir, form_id, form_number, started_datetime, payload)
+            if job is not None:
+                mark_stage(form_id, "Fetched", "JsonSaved", data_path=data_path)
+
+        # Render the JSON, Excel rows and HTML (on a render process if render_processes is set)
+        try:
+            artefacts = render.run(data, form_number, form_dir, input_dir, stages, cloud_path)
+        except Exception:
+            if "json" in stages:
+                save_json()  # Keep the response so the next run doesn't fetch it again
+            raise
+
+        if "json" in stages:
+            save_json(artefacts["json"])
+
+        # Save attachments
+        if not done["Attachments"]:
+            if download and "Files" in data["Result"]["Form"]:
+                os.makedirs(form_dir, exist_ok=True)
+                with metrics.timer("attachments"):
+                    results = attachments.fetch_all(data["Result"]["Form"]["Files"], form_dir)
+
+                # Check if downloads were successful
+                if 0 in results:
+                    with metrics.locked(lock):
+                        skipped_downloads.append(form_id)
+            if job is not None:
+                mark_stage(form_id, "Attachments")
+
+        # Excel rows are buffered and written to the workbook in batches.  Rows are tracked by
+        # FormID so the Excel stage is recorded once they are written (not when re-rendering).
+        workbook_path = os.path.join(output_dir, 'Process.xlsx')
+        row_key = None if rerender else form_id
+        pending_rows = 0
+
+        # Add the rows to the process's analytics dataset (before the workbook, so a form is never
+        # completed with its analytics rows unwritten)
+        analytics_rows = 0
+        if analytics.enabled():
+            for name in ("toc", "report"):
+                if artefacts[name] is not None:
+                    analytics_rows = analytics.add(
+                        output_dir, name, process_definitions[name], artefacts[name][1], form_id, started_datetime
+                    )
+
+        # Add Table of Contents entry to Report file
+        if artefacts["toc"] is not None:
+            pending_rows = excel.buffer(
+                workbook_path, artefacts["toc"], f"{sheet} TOC", row_key, excel.number_column(process_definitions["toc"])
             )
-            year = started_datetime.year
-            month = started_datetime.month
 
-            # Determine sheet name
-            if max_form > 5000:
-                sheet = f"{year}-{month}"
-            else:
-                sheet = str(year)
+        # Add form data to Report file
+        if artefacts["report"] is not None:
+            pending_rows = excel.buffer(
+                workbook_path, artefacts["report"], sheet, row_key, excel.number_column(process_definitions["report"])
+            )
 
-            form_number = data["Result"]["Form"]["Number"].replace('/', '').replace('"', '').strip()
+        # Checkpoint the workbook's rows so a crash loses at most excel_checkpoint rows
+        if pending_rows >= settings.get('excel_checkpoint', 1000):
+            flush_excel(workbook_path)
 
-            # Save JSON response
-            form_dir = os.path.join(output_dir, form_number)
+        # Write the analytics rows once analytics_batch are waiting, so memory use stays bounded
+        if analytics_rows >= settings.get('analytics_batch', 50000):
+            flush_analytics(output_dir)
+
+        # HTML report
+        if artefacts["html_local"] is not None:
+            # Define file paths
+            html_filename = os.path.join(form_dir, f"report_{form_number}.html")
+            local_filename = os.path.join(form_dir, f"report_{form_number}_local.html")
+            pdf_filename = os.path.join(form_dir, f"report_{form_number}.pdf")
+
+            # Write the SharePoint HTML (or the local HTML with --nocloud).  With SharePoint output the
+            # local HTML is only needed for the PDF, which is rendered from memory, unless keep_local_html is set.
             os.makedirs(form_dir, exist_ok=True)
-            json_filename = os.path.normpath(os.path.join(form_dir, f"{form_number}.json"))
-            with open(json_filename, 'w') as json_file:
-                json.dump(data, json_file, indent=4)
-
-            # Save attachments
-            if "Files" in data["Result"]["Form"]:
-                for file in data["Result"]["Form"]["Files"]:
-                    file_url = api.fetch_file_url(file["FileID"])
-                    local_file_path = download_file(file_url, form_dir, file["FileName"])
-
-                    # Check if download was successful
-                    if local_file_path == 0:
-                        with lock:
-                            skipped_downloads.append(form_id)
-
-            # Add Table of Contents entry to Report file
-            if os.path.exists(os.path.join(input_dir, "toc.json")):
-                toc_df = excel.dataframe(data, form_number, os.path.join(input_dir, "toc.json"))
-                with lock:
-                    excel.append(os.path.join(output_dir, 'Process.xlsx'), toc_df, f"{sheet} TOC")
-
-            # Add form data to Report file
-            if os.path.exists(os.path.join(input_dir, "report.json")):
-                report_df = excel.dataframe(data, form_number, os.path.join(input_dir, "report.json"))
-                with lock:
-                    excel.append(os.path.join(output_dir, 'Process.xlsx'), report_df, sheet)
-
-            # HTML report
-            if os.path.exists(os.path.join(input_dir, "html.json")):
-                # Load HTML definitions file
-                with open(os.path.join(input_dir, "html.json"), 'r') as config_file:
-                    html_config = json.load(config_file)
-
-                # Extract data
-                extracted_data = extract_data(data, html_config)
-
-                # Load HTML template file
-                html_template_path = os.path.join(input_dir, 'layout.html')
-                with open(html_template_path, 'r') as html_file:
-                    html_template = html_file.read()
-
-                # Render the HTML
-                css_content = ''
-                with open(os.path.join(settings['assets'], 'stylesheet.css'), 'r') as css_file:
-                    css_content = css_file.read()
-
-                logo_path = os.path.abspath(os.path.join(settings['assets'], 'logo.png'))
-                logo_url = path_to_file_url(logo_path)
-
-                # Set up Jinja2 template
-                template = env.from_string(html_template)
-
-                # Configure file links
-                files_html_relative = ""
-                files_html_full = ""
-                if "Files" in data["Result"]["Form"]:
-                    for file in data["Result"]["Form"]["Files"]:
-                        # Local file path
-                        local_file_path = os.path.join(form_dir, file["FileName"])
-                        file_url = path_to_file_url(local_file_path)
-
-                        if file["FileName"].lower().endswith('.pdf'):
-                            files_html_relative += (
-                                f'<p><a href="{file_url}" target="_blank">{file["FileName"]}</a></p>'
-                            )
-                        else:
-                            files_html_relative += (
-                                f'<p><img src="{file_url}" alt="{file["FileName"]}" '
-                                f'style="max-width: 200px;"></p>'
-                            )
-
-                        # SharePoint path (if not --nocloud)
-                        if not args.nocloud:
-                            full_url_path = urljoin(
-                                settings['sharepoint'],
-                                f'{process_name}/{x[1]}/{form_number}/{file["FileName"]}'
-                            )
-
-                            if file["FileName"].lower().endswith('.pdf'):
-                                files_html_full += (
-                                    f'<p><a href="{full_url_path}" target="_blank">'
-                                    f'{file["FileName"]}</a></p>'
-                                )
-                            else:
-                                files_html_full += (
-                                    f'<p><img src="{full_url_path}" alt="{file["FileName"]}" '
-                                    f'style="max-width: 200px;"></p>'
-                                )
-
-                # Render HTML with relative paths
-                html_content_relative = template.render(
-                    css_content=css_content,
-                    logo_url=logo_url,
-                    files_html=files_html_relative,
-                    **extracted_data
-                )
-
-                # Define file paths
-                html_filename = os.path.join(form_dir, f"report_{form_number}.html")
-                pdf_filename = os.path.join(form_dir, f"report_{form_number}.pdf")
-
-                # Write HTML to a file
+            if artefacts["html_cloud"] is None:
                 with open(html_filename, "w") as html_file:
-                    html_file.write(html_content_relative)
-
-                # Convert HTML to PDF
-                options = {'enable-local-file-access': True}
-                pdfkit.from_file(
-                    html_filename, pdf_filename, configuration=pdfkit_config, options=options
-                )
-
-                # Re-render HTML for SharePoint (if not --nocloud)
-                if not args.nocloud:
-                    # Render HTML with full URL paths
-                    html_content_full = template.render(
-                        css_url=urljoin(settings['sharepoint_assets'], 'stylesheet.css'),
-                        logo_url=urljoin(settings['sharepoint_assets'], 'logo.png'),
-                        files_html=files_html_full,
-                        **extracted_data
-                    )
+                    html_file.write(artefacts["html_local"])
+            else:
+                with open(html_filename, "w") as html_file:
+                    html_file.write(artefacts["html_cloud"])
+                if settings.get('keep_local_html'):
+                    with open(local_filename, "w") as html_file:
+                        html_file.write(artefacts["html_local"])
+            if job is not None:
+                mark_stage(form_id, "Html")
+
+            # Finish the form from the PDF render worker once its PDF has been written
+            def finish(ok):
+                if not ok:
+                    with metrics.locked(lock):
+                        skipped_forms.append(form_id)
+                    return
+
+                if job is not None:
+                    mark_stage(form_id, "Pdf")
+                if not rerender:
+                    complete_form(form_id)
+
+            # Queue the local HTML for conversion to PDF
+            pdf.submit(artefacts["html_local"], pdf_filename, finish)
+            return True
+
+        # Mark the form as completed in the database
+        if not rerender:
+            complete_form(form_id)
+
+    return True  # Indicate success
+
+# Function to export the forms of one process using a ThreadPoolExecutor.  Forms are submitted
+# from the form_ids iterator as others finish, so only form_window x max_workers are queued at once.
+def export_process_threads(form_ids, input_dir, output_dir, x, process_name, max_form, args, progress_bar):
+    global skipped_forms
+
+    executor = ThreadPoolExecutor(max_workers=settings['max_workers'])
+    window = settings.get('form_window', 4) * settings['max_workers']
+    form_ids = iter(form_ids)
+    futures = {}
+
+    # Function to top the window back up with the next forms
+    def submit_more():
+        while len(futures) < window and not api_limit_reached.is_set():
+            form_id = next(form_ids, None)
+            if form_id is None:
+                return
+            future = executor.submit(
+                process_single_form,
+                form_id,
+                input_dir,
+                output_dir,
+                x,
+                process_name,
+                max_form,
+                args
+            )
+            futures[future] = form_id
 
-                    # Write the HTML with full URL paths to a file
-                    with open(html_filename, "w") as html_file:
-                        html_file.write(html_content_full)
+    try:
+        submit_more()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                form_id = futures.pop(future)
+                try:
+                    result = future.result()
+                    # Update progress bar if form processed successfully
+                    if result:
+                        progress_bar.update(1)
+                except Exception as exc:
+                    print(f'\n        Form {form_id} generated an exception: {exc}')
+                    with metrics.locked(lock):
+                        skipped_forms.append(form_id)
+
+            # Check if API limit has been reached
+            if api_limit_reached.is_set():
+                print("\nAPI daily limit reached. Stopping further processing.")
+                break  # Exit the processing loop
+            submit_more()
+
+        # After breaking the loop, cancel any pending futures
+        if api_limit_reached.is_set():
+            print("API limit reached.  Shutting down.")
+            for future in futures:
+                if not future.done():
+                    future.cancel()
+
+            # Shutdown the executor immediately
+            executor.shutdown(wait=False)
+            return
 
-            # Mark the form as completed in the database
-            with lock:
-                database.form_complete(cursor, form_id, cnx)
-                cnx.commit()
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False)
+        raise
 
-        return True  # Indicate success
+    executor.shutdown(wait=True)
+
+# Async version of process_single_form.  API calls and attachment downloads run on the event loop,
+# while saving and rendering are handed to the bounded render executor.
+async def process_single_form_async(form_id, input_dir, output_dir, x, process_name, max_form, args, render_pool):
+    global skipped_forms, skipped_downloads
+    try:
+        # Check if API limit has been reached
+        if api_limit_reached.is_set():
+            return False  # Stop processing
+
+        loop = asyncio.get_running_loop()
+
+        # Claim the form so other runs sharing the queue leave it alone
+        job = await loop.run_in_executor(render_pool, claim_form, form_id, x[0])
+        if job is None:
+            return False
+
+        # Resume from the response saved by an earlier run if there is one
+        data = load_saved(job)
+        if data is None:
+            # Stop starting new forms before the daily budget runs out
+            if not api.quota_available():
+                api_limit_reached.set()
+                return False
+
+            # Get the form data from Cube
+            data = await async_engine.fetch_form(form_id)
+
+        # Download attachments concurrently (errors are reported by export_form)
+        if not job["Attachments"] and not data.get("Result", {}).get("Error") and data["Result"]["Form"].get("Files"):
+            form_number, form_dir = form_location(data, output_dir)
+            os.makedirs(form_dir, exist_ok=True)
+
+            results = await asyncio.gather(
+                *(async_engine.fetch_attachment(file, form_dir) for file in data["Result"]["Form"]["Files"])
+            )
+            if 0 in results:
+                with metrics.locked(lock):
+                    skipped_downloads.append(form_id)
+
+        return await loop.run_in_executor(
+            render_pool, functools.partial(
+                export_form, form_id, data, input_dir, output_dir, x, process_name, max_form, args, False, job
+            )
+        )
+
+    except api.LimitReached as e:
+        # The form is left unfinished, so its attachments are fetched on a later run
+        with metrics.locked(lock):
+            print(f"\n        ERROR: {e}. FormID: {form_id}")
+            api_limit_reached.set()
+        return False
 
     except Exception as e:
-        with lock:
+        with metrics.locked(lock):
             print(f"\n        ERROR processing form {form_id}: {e}")
             skipped_forms.append(form_id)
         return False  # Indicate failure
 
+# Function to export the forms of one process on an asyncio event loop
+def export_process_async(form_ids, input_dir, output_dir, x, process_name, max_form, args, progress_bar):
+    def handler(form_id):
+        return process_single_form_async(form_id, input_dir, output_dir, x, process_name, max_form, args, render_pool)
+
+    def on_done(form_id, result):
+        # Update progress bar if form processed successfully
+        if result:
+            progress_bar.update(1)
+
+    render_workers = settings.get('render_workers', settings['max_workers'])
+    with ThreadPoolExecutor(max_workers=render_workers) as render_pool:
+        async_engine.run(
+            form_ids, handler, on_done, api_limit_reached.is_set, settings.get('async_concurrency', 200)
+        )
+
+    if api_limit_reached.is_set():
+        print("\nAPI daily limit reached. Stopping further processing.")
+
+# Function to rebuild the Excel, HTML and PDF outputs of a process from the responses saved by
+# earlier exports (per-form JSON files and archives).  No API calls are made and attachments
+# aren't downloaded again.  Forms are rendered on render_workers threads and PDFs on the PDF workers.
+def rerender_process(input_dir, output_dir, x, process_name, args, progress_bar):
+    global skipped_forms
+
+    locations = archive.saved(output_dir)
+    max_form = len(locations)
+    progress_bar.reset(total=max_form)
+
+    # The workbook is rebuilt from scratch rather than merged with the old rows
+    excel.remove(os.path.join(output_dir, 'Process.xlsx'))
+    analytics.reset(output_dir)
+
+    def rerender_form(location):
+        data = archive.load(location)
+        if data is None:
+            return False
+        form_id = data["Result"]["Form"]["FormID"]
+        return export_form(
+            form_id, data, input_dir, output_dir, x, process_name, max_form, args, download=False, saved=True, rerender=True
+        )
+
+    window = settings.get('form_window', 4) * settings.get('render_workers', settings['max_workers'])
+    locations = iter(locations)
+    with ThreadPoolExecutor(max_workers=settings.get('render_workers', settings['max_workers'])) as executor:
+        futures = {}
+        while True:
+            # Keep the window full, then wait for a form to finish
+            for location in locations:
+                futures[executor.submit(rerender_form, location)] = location
+                if len(futures) >= window:
+                    break
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                location = futures.pop(future)
+                try:
+                    if future.result():
+                        progress_bar.update(1)
+                except Exception as exc:
+                    print(f'\n        {location} generated an exception: {exc}')
+                    with metrics.locked(lock):
+                        skipped_forms.append(location)
+
 def main(args):
     global settings
-    global pdfkit_config
+    global run_owner
     global skipped_processes, skipped_downloads, skipped_forms
 
     print("#############################")
@@ -470,11 +701,24 @@ def main(args):
     print("#############################")
     print("")
 
+    # The async engine needs the optional httpx package
+    if args.engine == "async" and not async_engine.available():
+        print("The async engine requires httpx.  Install it with: pip install httpx")
+        sys.exit(1)
+
+    # The analytics export needs pyarrow for Parquet files
+    try:
+        analytics.formats()
+    except (RuntimeError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
     # Set up database connection
     try:
         print("Creating database connection...")
         cnx = database.setup()
         cursor = cnx.cursor()
+        api.quota_load(cursor)
         print("OK")
         print("")
     except Exception as e:
@@ -484,15 +728,17 @@ def main(args):
     print("Synchronizing Cube indexes...")
     sleep(1)
 
-    # Only run sync operations if --nosync is not used
-    if not args.nosync:
+    # Only run sync operations if --nosync (or --rerender, which makes no API calls) is not used
+    if args.rerender:
+        print("Sync operations skipped, re-rendering from saved responses.")
+    elif not args.nosync:
         sync_groups(cursor, settings['api_urls']['groups'], cnx)
         sync_processes(cursor, settings['api_urls']['processes'], cnx)
 
         if args.sync:
-            sync_forms(cursor, settings['api_urls']['forms'], cnx, args.sync)
+            sync_forms(cursor, settings['api_urls']['forms'], cnx, args.sync, args.incremental)
         else:
-            sync_forms(cursor, settings['api_urls']['forms'], cnx)
+            sync_forms(cursor, settings['api_urls']['forms'], cnx, incremental=args.incremental)
     else:
         print("Sync operations skipped due to --nosync flag.")
 
@@ -500,7 +746,10 @@ def main(args):
     print("Getting list of processes to export...")
 
     # Get the list of processes
-    processes = database.process_list(cursor)
+    if args.rerender and args.rerender != 'all':
+        processes = database.process_specific(cursor, args.rerender)
+    else:
+        processes = database.process_list(cursor)
     print(f"Found {len(processes)} processes.")
 
     print("")
@@ -513,101 +762,123 @@ def main(args):
     print("")
     sleep(5)
 
-    print("Exporting forms...")
-
-    # Execute each process export script
-    y = 1
-    z = len(processes)
-    for x in processes:
-        input_dir = os.path.join(os.getcwd(), str(x[0]))  # Path to JSON definition files
-        process_name = database.group_name(cursor, x[2])
+    # Name this node so it can reclaim its own leases after a restart.  Runs without --shard are
+    # named after the machine, so a run restarted after a crash picks its processes straight back up.
+    if args.node:
+        run_owner = args.node
+    elif not args.shard:
+        run_owner = socket.gethostname()
 
-        # Create output directory
-        try:
-            output_dir = os.path.join(
-                settings['files'],
-                process_name,
-                x[1].replace('/', '').replace('"', '').strip()
-            )
-            os.makedirs(output_dir, exist_ok=True)
-        except OSError as e:
-            print(f"Error creating directory for form export: {e}")
-            continue
-
-        if os.path.exists(input_dir) and not glob.glob(os.path.join(output_dir, '*.xlsx')):
-            # Clear completed status for the process
-            database.process_reset(cursor, x[0], cnx)
-            cnx.commit()
-            print("    Definitions have been added to process, resetting form statuses")
-
-        # Get list of relevant forms for this process including export status
-        form_ids = database.form_fetch(cursor, x[0])
-
-        # Count number of forms
-        max_form = len(form_ids)
-        if max_form == 0:
-            continue  # Skip if no forms to process
-
-        # Initialize progress bar
-        progress_bar = tqdm(total=max_form, desc=f"    ({y} of {z}) {x[1]}")
-
-        try:
-            # Process forms using ThreadPoolExecutor
-            with ThreadPoolExecutor(max_workers=settings['max_workers']) as executor:
-                futures = {
-                    executor.submit(
-                        process_single_form,
-                        form_id,
-                        input_dir,
-                        output_dir,
-                        x,
-                        process_name,
-                        max_form,
-                        args
-                    ): form_id for form_id in form_ids
-                }
-
-                for future in as_completed(futures):
-                    form_id = futures[future]
-                    try:
-                        result = future.result()
-                        # Update progress bar if form processed successfully
-                        if result:
-                            progress_bar.update(1)
-                        # Check if API limit has been reached
-                        if api_limit_reached.is_set():
-                            print("\nAPI daily limit reached. Stopping further processing.")
-                            break  # Exit the processing loop
-                    except Exception as exc:
-                        print(f'\n        Form {form_id} generated an exception: {exc}')
-                        with lock:
-                            skipped_forms.append(form_id)
-
-                # After breaking the loop, cancel any pending futures
-                if api_limit_reached.is_set():
-                    print("API limit reached.  Shutting down.")
-                    for future in futures:
-                        if not future.done():
-                            future.cancel()
-
-                    # Shutdown the executor immediately
-                    executor.shutdown(wait=False)
-                    break  # Exit the outer process loop if desired
-
-        except KeyboardInterrupt:
-            print("\nKeyboardInterrupt received, shutting down...")
-            executor.shutdown(wait=False)
-            sys.exit(1)
-
-        # Close progress bar
-        progress_bar.close()
-
-        y += 1
+    print("Exporting forms...")
+    pdf.start()
+    render.start()
+    completions.start()
 
-        # Check if API limit has been reached to exit outer loop
-        if api_limit_reached.is_set():
-            break
+    # Keep claims and leases alive for as long as this run is working
+    stop_renewing = threading.Event()
+    threading.Thread(target=renew_claims, args=(stop_renewing,), daemon=True).start()
 
+    # Claims and leases are given up however the export ends, so a restarted run isn't locked out
+    # of them until they expire
+    try:
+        # With --shard, processes are claimed from the shared database instead of taken in order
+        already_reset = set()
+        if args.shard and not args.rerender:
+            already_reset = reset_added_definitions(cursor, processes, cnx)
+            print(f"    Claiming processes as node {run_owner}")
+            processes = claimed_processes(cursor, cnx)
+
+        print(f"    {api.quota_remaining()} API calls left in today's budget")
+
+        # Execute each process export script
+        export_started = time.perf_counter()
+        y = 1
+        # Claimed processes aren't known up front, so --shard counts the whole catalogue instead
+        z = len(processes) if isinstance(processes, list) else database.process_count(cursor)
+        for x in processes:
+            input_dir = os.path.join(os.getcwd(), str(x[0]))  # Path to JSON definition files
+            process_name = database.group_name(cursor, x[2])
+
+            # Create output directory
+            try:
+                output_dir = process_folder(process_name, x)
+                os.makedirs(output_dir, exist_ok=True)
+            except OSError as e:
+                print(f"Error creating directory for form export: {e}")
+                continue
+
+            # Processes not claimed through --shard are claimed here, so two runs never export (and
+            # rewrite the workbook of) the same process at once
+            claimed = args.shard and not args.rerender
+            if not claimed and not database.process_claim_specific(cursor, x[0], run_owner, lease_expiry(), datetime.now(), cnx):
+                print(f"    {x[1]} is being exported by another run, skipping")
+                y += 1
+                continue
+
+            # Re-render processes with definition files from their saved responses
+            if args.rerender:
+                if os.path.exists(input_dir):
+                    progress_bar = tqdm(total=0, desc=f"    ({y} of {z}) {x[1]}")
+                    rerender_process(input_dir, output_dir, x, process_name, args, progress_bar)
+                    pdf.wait()
+                    flush_excel()
+                    completions.flush()
+                    progress_bar.close()
+                y += 1
+                continue
+
+            # Rows a crashed run checkpointed are merged into the workbook at the end of this process
+            excel.recover(os.path.join(output_dir, 'Process.xlsx'))
+
+            if x[0] not in already_reset and definitions_added(input_dir, output_dir):
+                reset_process(cursor, x, output_dir, cnx)
+
+            # Don't start another process once the daily budget is spent
+            if not api.quota_available():
+                api_limit_reached.set()
+                print("\nAPI daily budget used. Stopping further processing.")
+                break
+
+            # Count the forms left to export, then stream their IDs from the database as workers free up
+            max_form = database.form_count(cursor, x[0])
+            if max_form == 0:
+                continue  # Skip if no forms to process
+            form_ids = database.form_iter(cursor, x[0], cnx, settings.get('form_page_size', 1000))
+
+            # Initialize progress bar
+            progress_bar = tqdm(total=max_form, desc=f"    ({y} of {z}) {x[1]}")
+
+            try:
+                if args.engine == "async":
+                    export_process_async(form_ids, input_dir, output_dir, x, process_name, max_form, args, progress_bar)
+                else:
+                    export_process_threads(form_ids, input_dir, output_dir, x, process_name, max_form, args, progress_bar)
+            except KeyboardInterrupt:
+                print("\nKeyboardInterrupt received, shutting down...")
+                flush_excel()
+                completions.stop()
+                sys.exit(1)
+
+            # Wait for this process's PDFs, then write the buffered Excel rows and completions
+            pdf.wait()
+            flush_excel()
+            completions.flush()
+            archive.close(output_dir)
+
+            # Close progress bar
+            progress_bar.close()
+
+            y += 1
+
+            # Check if API limit has been reached to exit outer loop
+            if api_limit_reached.is_set():
+                break
+    finally:
+        stop_renewing.set()
+        database.job_release(cursor, run_owner, cnx)
+        database.process_release(cursor, run_owner, cnx)
+
+    metrics.observe("export", time.perf_counter() - export_started)
     print("OK!")
     print("")
 
@@ -632,10 +903,22 @@ def main(args):
             print(f"FormID: {x}")
             print()
 
+    # Stop the PDF render workers, write the last completions and give up any leases this run still holds
+    pdf.stop()
+    render.stop()
+    completions.stop()
+    archive.close()
+
+    # Write the run report
+    report_path = metrics.write_report(os.path.join(settings['files'], '_reports'))
+    print(f"Run report saved to {report_path}")
+    print("")
+
     # Close database connection
     print("Closing database connection...")
     cursor.close()
     cnx.close()
+    api.close()
     print("OK!")
 
     print("")
@@ -659,6 +942,33 @@ if __name__ == "__main__":
         type=str,
         help="Sync only ONE process. Specify the ProcessID"
     )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Only sync the forms of processes whose Modified date or form count changed since the last sync"
+    )
+    parser.add_argument(
+        '--shard',
+        action='store_true',
+        help="Claim processes from the shared database so several nodes can export at once"
+    )
+    parser.add_argument(
+        '--node',
+        type=str,
+        help="Name used for this node's claims (default: the hostname, or hostname-pid with --shard)"
+    )
+    parser.add_argument(
+        '--rerender',
+        nargs='?',
+        const='all',
+        help="Rebuild Excel, HTML and PDF outputs from saved responses without API calls (optionally for ONE ProcessID)"
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['threads', 'async'],
+        default='threads',
+        help="Export engine to use. 'async' runs API calls and downloads on an asyncio event loop (requires httpx)"
+    )
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,128 @@
+import config
+from contextlib import contextmanager
+import csv
+from datetime import datetime
+import json
+import os
+import threading
+import time
+
+# Load settings file
+settings = config.load()
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
+
+# Latency histograms keyed by stage, and counters keyed by name
+_histograms = {}
+_counters = {}
+_metrics_lock = threading.Lock()
+_started = time.time()
+
+# Function to record how long a stage took
+def observe(stage, seconds):
+    with _metrics_lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(BUCKETS)}
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["max"] = max(histogram["max"], seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+                break
+
+# Function to add to a counter (eg. bytes downloaded, API calls to an endpoint)
+def count(name, value=1):
+    with _metrics_lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+# Context manager that times the block it wraps as a stage
+@contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+# Context manager that acquires a lock and records how long the caller waited for it
+@contextmanager
+def locked(lock, name="lock"):
+    start = time.perf_counter()
+    with lock:
+        observe(f"lock_wait.{name}", time.perf_counter() - start)
+        yield
+
+# Function to return a copy of everything recorded so far
+def snapshot():
+    with _metrics_lock:
+        return {
+            "started": datetime.fromtimestamp(_started).isoformat(timespec='seconds'),
+            "elapsed": round(time.time() - _started, 3),
+            "stages": {
+                stage: {
+                    "count": histogram["count"],
+                    "sum": round(histogram["sum"], 6),
+                    "mean": round(histogram["sum"] / histogram["count"], 6) if histogram["count"] else 0,
+                    "max": round(histogram["max"], 6),
+                    "buckets": dict(zip((str(bound) for bound in BUCKETS), histogram["buckets"])),
+                }
+                for stage, histogram in sorted(_histograms.items())
+            },
+            "counters": dict(sorted(_counters.items())),
+        }
+
+# Function to write the run report as JSON and CSV into folder (and a Prometheus textfile if
+# prometheus_textfile is set in config.json).  Returns the path of the JSON report.
+def write_report(folder):
+    report = snapshot()
+    os.makedirs(folder, exist_ok=True)
+    name = f"run-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+
+    json_path = os.path.join(folder, f"{name}.json")
+    with open(json_path, 'w') as json_file:
+        json.dump(report, json_file, indent=4)
+
+    with open(os.path.join(folder, f"{name}.csv"), 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["type", "name", "count", "sum", "mean", "max"] + [f"le_{bound}" for bound in BUCKETS])
+        for stage, values in report["stages"].items():
+            writer.writerow(
+                ["stage", stage, values["count"], values["sum"], values["mean"], values["max"]]
+                + list(values["buckets"].values())
+            )
+        for counter, value in report["counters"].items():
+            writer.writerow(["counter", counter, value])
+
+    if settings.get('prometheus_textfile'):
+        write_prometheus(settings['prometheus_textfile'], report)
+
+    return json_path
+
+# Function to write the report in the Prometheus textfile collector format
+def write_prometheus(path, report):
+    lines = [
+        "# TYPE lighthouse_stage_seconds histogram",
+    ]
+    for stage, values in report["stages"].items():
+        cumulative = 0
+        for bound, bucket in values["buckets"].items():
+            cumulative += bucket
+            le = "+Inf" if bound == "inf" else bound
+            lines.append(f'lighthouse_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+        lines.append(f'lighthouse_stage_seconds_sum{{stage="{stage}"}} {values["sum"]}')
+        lines.append(f'lighthouse_stage_seconds_count{{stage="{stage}"}} {values["count"]}')
+
+    lines.append("# TYPE lighthouse_total counter")
+    for counter, value in report["counters"].items():
+        lines.append(f'lighthouse_total{{name="{counter}"}} {value}')
+    lines.append("# TYPE lighthouse_run_seconds gauge")
+    lines.append(f"lighthouse_run_seconds {report['elapsed']}")
+
+    # Write then rename so the collector never reads a half-written file
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as prom_file:
+        prom_file.write("\n".join(lines) + "\n")
+    os.replace(temp_path, path)
@@ -0,0 +1,52 @@
+--
+-- Brings a database created from the original schema.sql (forms, groups and processes only)
+-- up to date: API usage, the jobs queue, the attachment store, form Modified dates and the
+-- process sync and claim columns.  Objects that already exist are left as they are.
+--
+
+CREATE TABLE IF NOT EXISTS `api_usage` (
+  `Day` date NOT NULL,
+  `KeyID` char(16) NOT NULL,
+  `Calls` int(11) NOT NULL,
+  PRIMARY KEY (`Day`,`KeyID`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+CREATE TABLE IF NOT EXISTS `jobs` (
+  `Form` int(8) NOT NULL,
+  `ProcessID` int(8) NOT NULL,
+  `Fetched` tinyint(1) NOT NULL DEFAULT 0,
+  `JsonSaved` tinyint(1) NOT NULL DEFAULT 0,
+  `Attachments` tinyint(1) NOT NULL DEFAULT 0,
+  `Excel` tinyint(1) NOT NULL DEFAULT 0,
+  `Html` tinyint(1) NOT NULL DEFAULT 0,
+  `Pdf` tinyint(1) NOT NULL DEFAULT 0,
+  `DataPath` varchar(255) DEFAULT NULL,
+  `LeaseOwner` varchar(64) DEFAULT NULL,
+  `LeaseExpires` datetime DEFAULT NULL,
+  `Attempts` int(11) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`Form`),
+  KEY `jobs_process` (`ProcessID`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+CREATE TABLE IF NOT EXISTS `files` (
+  `FileID` int(11) NOT NULL,
+  `Hash` char(64) NOT NULL,
+  `Size` bigint(20) NOT NULL,
+  PRIMARY KEY (`FileID`),
+  KEY `files_hash` (`Hash`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+ALTER TABLE `forms`
+  ADD `Modified` datetime DEFAULT NULL AFTER `Archived`;
+
+ALTER TABLE `processes`
+  ADD `SyncedModified` date DEFAULT NULL;
+
+ALTER TABLE `processes`
+  ADD `SyncedForms` int(8) DEFAULT NULL;
+
+ALTER TABLE `processes`
+  ADD `ClaimedBy` varchar(64) DEFAULT NULL;
+
+ALTER TABLE `processes`
+  ADD `ClaimExpires` datetime DEFAULT NULL;
@@ -0,0 +1,13 @@
+--
+-- Indexes for the per-process form lookups (form_iter, process_reset, form_insert_many)
+-- and for releasing or renewing a run's job leases.
+--
+
+ALTER TABLE `forms`
+  ADD KEY `forms_process_completed` (`ProcessID`,`Completed`,`Form`);
+
+ALTER TABLE `jobs`
+  ADD KEY `jobs_lease_owner` (`LeaseOwner`);
+
+ALTER TABLE `processes`
+  ADD KEY `processes_claimed_by` (`ClaimedBy`);
@@ -0,0 +1,45 @@
+--
+-- Brings a database from before migrations up to date: API usage, the jobs queue, the
+-- attachment store, form Modified dates and the process sync and claim columns.  Objects
+-- that already exist are left as they are.
+--
+
+CREATE TABLE IF NOT EXISTS `api_usage` (
+  `Day` date NOT NULL,
+  `KeyID` char(16) NOT NULL,
+  `Calls` integer NOT NULL,
+  PRIMARY KEY (`Day`, `KeyID`)
+);
+
+CREATE TABLE IF NOT EXISTS `jobs` (
+  `Form` integer PRIMARY KEY,
+  `ProcessID` integer NOT NULL,
+  `Fetched` tinyint NOT NULL DEFAULT 0,
+  `JsonSaved` tinyint NOT NULL DEFAULT 0,
+  `Attachments` tinyint NOT NULL DEFAULT 0,
+  `Excel` tinyint NOT NULL DEFAULT 0,
+  `Html` tinyint NOT NULL DEFAULT 0,
+  `Pdf` tinyint NOT NULL DEFAULT 0,
+  `DataPath` varchar(255) DEFAULT NULL,
+  `LeaseOwner` varchar(64) DEFAULT NULL,
+  `LeaseExpires` datetime DEFAULT NULL,
+  `Attempts` integer NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS `jobs_process` ON `jobs` (`ProcessID`);
+
+CREATE TABLE IF NOT EXISTS `files` (
+  `FileID` integer PRIMARY KEY,
+  `Hash` char(64) NOT NULL,
+  `Size` bigint NOT NULL
+);
+CREATE INDEX IF NOT EXISTS `files_hash` ON `files` (`Hash`);
+
+ALTER TABLE `forms` ADD `Modified` datetime DEFAULT NULL;
+
+ALTER TABLE `processes` ADD `SyncedModified` date DEFAULT NULL;
+
+ALTER TABLE `processes` ADD `SyncedForms` integer DEFAULT NULL;
+
+ALTER TABLE `processes` ADD `ClaimedBy` varchar(64) DEFAULT NULL;
+
+ALTER TABLE `processes` ADD `ClaimExpires` datetime DEFAULT NULL;
@@ -0,0 +1,10 @@
+--
+-- Indexes for the per-process form lookups (form_iter, process_reset, form_insert_many)
+-- and for releasing or renewing a run's job leases.
+--
+
+CREATE INDEX IF NOT EXISTS `forms_process_completed` ON `forms` (`ProcessID`, `Completed`, `Form`);
+
+CREATE INDEX IF NOT EXISTS `jobs_lease_owner` ON `jobs` (`LeaseOwner`);
+
+CREATE INDEX IF NOT EXISTS `processes_claimed_by` ON `processes` (`ClaimedBy`);
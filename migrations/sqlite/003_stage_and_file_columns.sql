@@ -0,0 +1,12 @@
+--
+-- When a form was last exported, when its job last finished a stage, and the name and
+-- time each attachment was added to the blob store.
+--
+
+ALTER TABLE `forms` ADD `Exported` datetime DEFAULT NULL;
+
+ALTER TABLE `jobs` ADD `Updated` datetime DEFAULT NULL;
+
+ALTER TABLE `files` ADD `FileName` varchar(255) DEFAULT NULL;
+
+ALTER TABLE `files` ADD `Stored` datetime DEFAULT NULL;
@@ -1,15 +1,106 @@
 import config
+import metrics
 import pdfkit
+import queue
+import threading
 
 #Load settings file
 settings = config.load()
 
-def config():
-    global settings
-    
-    path_wkhtmltopdf = config['wkhtmltopdf']
-    pdfkit_config = pdfkit.configuration(wkhtmltopdf=path_wkhtmltopdf)
-    return pdfkit_config
+# Render queue and worker threads, created by start()
+_queue = None
+_workers = []
+_pdfkit_config = None
 
-def generate_pdf(html_content, output_path, pdfkit_config):
-    pdfkit.from_string(html_content, output_path, configuration=pdfkit_config)
\ No newline at end of file
+# Options passed to wkhtmltopdf so reports can load local attachments and assets
+options = {'enable-local-file-access': True}
+
+# Function to return the pdfkit configuration for the wkhtmltopdf install in config.json
+def configuration():
+    global _pdfkit_config
+
+    if _pdfkit_config is None:
+        _pdfkit_config = pdfkit.configuration(wkhtmltopdf=settings['wkhtmltopdf'])
+    return _pdfkit_config
+
+def generate_pdf(html_content, output_path, pdfkit_config=None):
+    pdfkit.from_string(html_content, output_path, configuration=pdfkit_config or configuration(), options=options)
+
+# Function to convert rendered HTML to PDF with the renderer set in config.json, without writing
+# the HTML to disk first.  "wkhtmltopdf" (default) runs one wkhtmltopdf process per file,
+# "weasyprint" renders in-process.
+def render(html_content, pdf_path):
+    renderer = settings.get('pdf_renderer', 'wkhtmltopdf')
+
+    if renderer == 'weasyprint':
+        import weasyprint
+        weasyprint.HTML(string=html_content).write_pdf(pdf_path)
+    else:
+        generate_pdf(html_content, pdf_path)
+
+# Function to start the PDF render workers.  Forms are queued by submit() so API and
+# download work doesn't wait on PDF rendering.
+def start(workers=None):
+    global _queue, _workers
+
+    if _queue is not None:
+        return
+
+    _queue = queue.Queue(maxsize=settings.get('pdf_queue_size', 100))
+    for _ in range(workers or settings.get('pdf_workers', 4)):
+        worker = threading.Thread(target=_worker, args=(_queue,), daemon=True)
+        worker.start()
+        _workers.append(worker)
+
+# Function to queue rendered HTML for PDF rendering.  on_done(ok) is called from the render
+# worker once the PDF has been written (or failed).  Renders straight away if start() wasn't called.
+def submit(html_content, pdf_path, on_done=None):
+    if _queue is None:
+        _run(html_content, pdf_path, on_done)
+    else:
+        with metrics.timer("pdf_queue_wait"):
+            _queue.put((html_content, pdf_path, on_done))  # Blocks while the queue is full
+
+# Function to wait for every queued PDF to finish rendering
+def wait():
+    if _queue is not None:
+        _queue.join()
+
+# Function to finish the queued PDFs and stop the render workers
+def stop():
+    global _queue, _workers
+
+    if _queue is None:
+        return
+
+    for _ in _workers:
+        _queue.put(None)
+    for worker in _workers:
+        worker.join()
+    _queue = None
+    _workers = []
+
+def _worker(jobs):
+    while True:
+        job = jobs.get()
+        try:
+            if job is None:
+                return
+            _run(*job)
+        finally:
+            jobs.task_done()
+
+def _run(html_content, pdf_path, on_done):
+    try:
+        with metrics.timer("pdf"):
+            render(html_content, pdf_path)
+        ok = True
+    except Exception as e:
+        print(f"\n        ERROR rendering PDF {pdf_path}: {e}")
+        ok = False
+
+    if on_done is not None:
+        try:
+            on_done(ok)
+        except Exception as e:
+            print(f"\n        ERROR finishing {pdf_path}: {e}")
@@ -0,0 +1,263 @@
+import archive
+import config
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import definitions
+import excel
+import json
+import logging
+import metrics
+import multiprocessing
+import os
+from pathlib import Path
+import time
+from urllib.parse import urljoin
+
+# Load settings file
+settings = config.load()
+
+# Pool of render processes, created by start() when render_processes is set in config.json
+_pool = None
+
+def extract_field(data, field_def, index=None):
+    # Determine the key to match on ('Field' or 'Uid')
+    match_on = field_def.get('match_on', 'Field')
+
+    # Fields of the form itself are looked up in the form's field index when one is given
+    if (index is not None and "field" in field_def and match_on in index
+            and field_def.get("path", "").split('.') == excel.FIELDS_PATH):
+        field = index[match_on].get(field_def['field'])
+        if field is None:
+            logging.warning(f"Field '{field_def['field']}' not found in data.")
+            return None
+        return extract_matched_field(field, field_def)
+
+    # Navigate through the path defined in field_def["path"]
+    parts = field_def.get("path", "").split('.')
+    for part in parts:
+        if isinstance(data, dict) and part in data:
+            data = data[part]
+        else:
+            logging.warning(f"Path '{'.'.join(parts)}' not found in data.")
+            return None  # Handle missing paths gracefully
+
+    # If there's a specific field to extract, handle it
+    if "field" in field_def:
+        # Ensure that 'data' is a list or collection of fields
+        if isinstance(data, list):
+            for field in data:
+                # Check if the current item in the list is a dictionary with the matching key
+                if isinstance(field, dict) and match_on in field:
+                    if field[match_on] == field_def['field']:
+                        return extract_matched_field(field, field_def)
+            # If we didn't find the field, return None
+            logging.warning(f"Field '{field_def['field']}' not found in data.")
+            return None
+        else:
+            logging.warning(f"Expected a list for field '{field_def['field']}' but got {type(data)}")
+            return None
+    else:
+        # If no 'field' key, return data
+        return data
+
+# Function to extract the value (or subfield rows) of a field matched by extract_field
+def extract_matched_field(field, field_def):
+    # If there is a 'subfield', we need to drill down further
+    if "subfield" in field_def:
+        subfield_data = field.get(field_def['subfield'], [])
+        if subfield_data:
+            # Handle the 'extract' definitions
+            if "extract" in field_def:
+                extracted_items = []
+                for item in subfield_data:
+                    item_data = {}
+                    for subfield_name, subfield_def in field_def['extract'].items():
+                        # For nested paths in subfields, adjust the path
+                        subfield_def_relative = subfield_def.copy()
+                        subfield_def_relative['path'] = subfield_def.get('path', '')
+                        value = extract_field(item, subfield_def_relative)
+                        item_data[subfield_name] = value
+                    extracted_items.append(item_data)
+                return extracted_items
+            else:
+                return subfield_data
+        else:
+            logging.info(f"No data found for subfield '{field_def['subfield']}' in field '{field_def['field']}'.")
+            return []
+    else:
+        # Extract the 'Value' or 'Values' from the field
+        return extract_value(field, field_def)
+
+def extract_value(field, field_def):
+    value = None
+    if 'Value' in field:
+        value = field['Value']
+    elif 'Values' in field and field['Values']:
+        # Extract all values and join them if necessary
+        values = [v.get('Value', '') for v in field['Values']]
+        value = ', '.join(values)
+    else:
+        value = None
+
+    # Parse JSON if needed
+    if field_def.get('parse_json') and value:
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError as e:
+            logging.warning(f"Could not parse JSON value: {e}")
+            value = None
+
+    # Convert to appropriate type if specified
+    if value is not None and 'type' in field_def:
+        value = convert_type(value, field_def['type'])
+
+    return value
+
+def convert_type(value, type_str):
+    try:
+        if type_str == 'int':
+            return int(value)
+        elif type_str == 'float':
+            return float(value)
+        elif type_str == 'date':
+            # Adjust the date format as needed
+            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except (ValueError, TypeError) as e:
+        logging.warning(f"Could not convert value '{value}' to type '{type_str}': {e}")
+        return value  # Return the original value if conversion fails
+
+    return value
+
+def extract_data(data, html_json, index=None):
+    # Index the form's fields once for all of the definitions
+    if index is None:
+        index = excel.field_index(data)
+
+    extracted = {}
+    for field_name, field_def in html_json['fields_to_extract'].items():
+        extracted[field_name] = extract_field(data, field_def, index)
+    return extracted
+
+def path_to_file_url(path):
+    return Path(path).as_uri()
+
+# Function to build the link model of a form's attachments once for both HTML reports: each
+# file's name, whether it is a PDF (linked) or an image (shown inline), and its local file URL and
+# SharePoint URL.  cloud_path is the form's folder under the SharePoint library, or None.
+def file_links(files, form_dir, cloud_path=None):
+    links = []
+    for file in files:
+        links.append({
+            "name": file["FileName"],
+            "pdf": file["FileName"].lower().endswith('.pdf'),
+            "local": path_to_file_url(os.path.join(form_dir, file["FileName"])),
+            "cloud": urljoin(settings['sharepoint'], f'{cloud_path}{file["FileName"]}') if cloud_path is not None else None,
+        })
+    return links
+
+# Function to build the attachment HTML of a report from a link model, using the "local" or "cloud" URLs
+def files_html(links, target):
+    return "".join(
+        f'<p><a href="{link[target]}" target="_blank">{link["name"]}</a></p>' if link["pdf"]
+        else f'<p><img src="{link[target]}" alt="{link["name"]}" style="max-width: 200px;"></p>'
+        for link in links
+    )
+
+# Function to render the artefacts of one form: the saved response, its Excel rows (header and row
+# tuples for excel.buffer) and its HTML reports.  Only the stages named in stages ("json", "excel",
+# "html") are rendered.  It depends on nothing but its arguments and the definition files in
+# input_dir, so it can run in a render process.
+# cloud_path is the form's folder under the SharePoint library, or None to skip the SharePoint HTML.
+def render_form(data, form_number, form_dir, input_dir, stages, cloud_path=None):
+    artefacts = {"json": None, "toc": None, "report": None, "html_local": None, "html_cloud": None, "times": {}}
+
+    # Serialise the response the way archive.save() writes it
+    if "json" in stages:
+        artefacts["json"] = archive.serialise(data)
+
+    if not stages & {"excel", "html"}:
+        return artefacts
+
+    # Load the process's definition files (cached until they change on disk)
+    process_definitions = definitions.load(input_dir)
+
+    # Index the form's fields once for the TOC, report and HTML extractors
+    index = excel.field_index(data)
+
+    if "excel" in stages:
+        excel_start = time.perf_counter()
+        for name in ("toc", "report"):
+            columns = process_definitions[name]
+            if columns is not None:
+                artefacts[name] = (excel.header(columns), excel.row(data, form_number, columns, index))
+        artefacts["times"]["excel_rows"] = time.perf_counter() - excel_start
+
+    if "html" in stages and process_definitions["html"] is not None:
+        html_start = time.perf_counter()
+        # Extract the fields and build the attachment links once for both reports
+        context = extract_data(data, process_definitions["html"], index)
+        links = file_links(data["Result"]["Form"].get("Files") or [], form_dir, cloud_path)
+        template = process_definitions["template"]
+
+        # Render HTML with local file paths (used for the PDF)
+        artefacts["html_local"] = template.render(
+            context,
+            css_content=definitions.stylesheet(),
+            logo_url=definitions.logo_url(),
+            files_html=files_html(links, "local")
+        )
+
+        # Render HTML with full URL paths for SharePoint
+        if cloud_path is not None:
+            artefacts["html_cloud"] = template.render(
+                context,
+                css_url=urljoin(settings['sharepoint_assets'], 'stylesheet.css'),
+                logo_url=urljoin(settings['sharepoint_assets'], 'logo.png'),
+                files_html=files_html(links, "cloud")
+            )
+        artefacts["times"]["html"] = time.perf_counter() - html_start
+
+    return artefacts
+
+# Function run in each render process as it starts, so warnings are logged as in the main process
+def _init():
+    logging.basicConfig(level=logging.INFO)
+
+# Function to start the render processes.  Jinja, pandas and JSON work is CPU bound and holds the
+# GIL, so with render_processes set it runs on that many processes instead of the export threads.
+def start(processes=None):
+    global _pool
+
+    processes = settings.get('render_processes', 0) if processes is None else processes
+    if _pool is not None or not processes:
+        return
+
+    options = {}
+    if settings.get('render_max_tasks'):
+        options['max_tasks_per_child'] = settings['render_max_tasks']  # Recycle processes to cap their memory
+    _pool = ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context('spawn'), initializer=_init, **options
+    )
+
+# Function to render a form (see render_form) on a render process, or in the calling thread if
+# start() wasn't called or there is only JSON to serialise.  Blocks until the artefacts are ready.
+def run(data, form_number, form_dir, input_dir, stages, cloud_path=None):
+    with metrics.timer("render"):
+        if _pool is None or not stages & {"excel", "html"}:
+            artefacts = render_form(data, form_number, form_dir, input_dir, stages, cloud_path)
+        else:
+            artefacts = _pool.submit(
+                render_form, data, form_number, form_dir, input_dir, stages, cloud_path
+            ).result()
+
+    for stage, seconds in artefacts["times"].items():
+        metrics.observe(stage, seconds)
+    return artefacts
+
+# Function to stop the render processes
+def stop():
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
@@ -23,6 +23,18 @@ SET time_zone = "+00:00";
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `api_usage`
+--
+
+CREATE TABLE `api_usage` (
+  `Day` date NOT NULL,
+  `KeyID` char(16) NOT NULL,
+  `Calls` int(11) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `forms`
 --
@@ -32,7 +44,23 @@ CREATE TABLE `forms` (
   `ProcessID` int(8) NOT NULL,
   `Form` int(8) NOT NULL,
   `Archived` tinyint(1) NOT NULL,
-  `Completed` tinyint(1) NOT NULL
+  `Modified` datetime DEFAULT NULL,
+  `Completed` tinyint(1) NOT NULL,
+  `Exported` datetime DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `files`
+--
+
+CREATE TABLE `files` (
+  `FileID` int(11) NOT NULL,
+  `Hash` char(64) NOT NULL,
+  `Size` bigint(20) NOT NULL,
+  `FileName` varchar(255) DEFAULT NULL,
+  `Stored` datetime DEFAULT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
 -- --------------------------------------------------------
@@ -48,6 +76,28 @@ CREATE TABLE `groups` (
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `jobs`
+--
+
+CREATE TABLE `jobs` (
+  `Form` int(8) NOT NULL,
+  `ProcessID` int(8) NOT NULL,
+  `Fetched` tinyint(1) NOT NULL DEFAULT 0,
+  `JsonSaved` tinyint(1) NOT NULL DEFAULT 0,
+  `Attachments` tinyint(1) NOT NULL DEFAULT 0,
+  `Excel` tinyint(1) NOT NULL DEFAULT 0,
+  `Html` tinyint(1) NOT NULL DEFAULT 0,
+  `Pdf` tinyint(1) NOT NULL DEFAULT 0,
+  `DataPath` varchar(255) DEFAULT NULL,
+  `LeaseOwner` varchar(64) DEFAULT NULL,
+  `LeaseExpires` datetime DEFAULT NULL,
+  `Attempts` int(11) NOT NULL DEFAULT 0,
+  `Updated` datetime DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `processes`
 --
@@ -62,19 +112,58 @@ CREATE TABLE `processes` (
   `Archived` int(8) NOT NULL,
   `Fields` int(8) NOT NULL,
   `GroupID` int(8) NOT NULL,
-  `RepeatingFields` tinyint(1) NOT NULL
+  `RepeatingFields` tinyint(1) NOT NULL,
+  `SyncedModified` date DEFAULT NULL,
+  `SyncedForms` int(8) DEFAULT NULL,
+  `ClaimedBy` varchar(64) DEFAULT NULL,
+  `ClaimExpires` datetime DEFAULT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `schema_version`
+--
+
+CREATE TABLE `schema_version` (
+  `Version` int(11) NOT NULL,
+  `Applied` datetime NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+--
+-- Dumping data for table `schema_version`
+-- (every migration in migrations/mysql is already part of this schema)
+--
+
+INSERT INTO `schema_version` (`Version`, `Applied`) VALUES
+(1, '2024-09-30 04:54:00'),
+(2, '2024-09-30 04:54:00'),
+(3, '2024-09-30 04:54:00');
+
 --
 -- Indexes for dumped tables
 --
 
+--
+-- Indexes for table `api_usage`
+--
+ALTER TABLE `api_usage`
+  ADD PRIMARY KEY (`Day`,`KeyID`);
+
 --
 -- Indexes for table `forms`
 --
 ALTER TABLE `forms`
   ADD PRIMARY KEY (`ID`),
-  ADD UNIQUE KEY `unique_form` (`Form`);
+  ADD UNIQUE KEY `unique_form` (`Form`),
+  ADD KEY `forms_process_completed` (`ProcessID`,`Completed`,`Form`);
+
+--
+-- Indexes for table `files`
+--
+ALTER TABLE `files`
+  ADD PRIMARY KEY (`FileID`),
+  ADD KEY `files_hash` (`Hash`);
 
 --
 -- Indexes for table `groups`
@@ -82,11 +171,26 @@ ALTER TABLE `forms`
 ALTER TABLE `groups`
   ADD PRIMARY KEY (`ID`);
 
+--
+-- Indexes for table `jobs`
+--
+ALTER TABLE `jobs`
+  ADD PRIMARY KEY (`Form`),
+  ADD KEY `jobs_process` (`ProcessID`),
+  ADD KEY `jobs_lease_owner` (`LeaseOwner`);
+
 --
 -- Indexes for table `processes`
 --
 ALTER TABLE `processes`
-  ADD PRIMARY KEY (`ProcessID`);
+  ADD PRIMARY KEY (`ProcessID`),
+  ADD KEY `processes_claimed_by` (`ClaimedBy`);
+
+--
+-- Indexes for table `schema_version`
+--
+ALTER TABLE `schema_version`
+  ADD PRIMARY KEY (`Version`);
 
 --
 -- AUTO_INCREMENT for dumped tables
@@ -0,0 +1,82 @@
+--
+-- Schema for the SQLite backend (db_backend "sqlite" in config.json).
+-- Applied automatically the first time the database is opened, and includes every
+-- migration in migrations/sqlite up to the version recorded in `schema_version`.
+--
+
+CREATE TABLE IF NOT EXISTS `api_usage` (
+  `Day` date NOT NULL,
+  `KeyID` char(16) NOT NULL,
+  `Calls` integer NOT NULL,
+  PRIMARY KEY (`Day`, `KeyID`)
+);
+
+CREATE TABLE IF NOT EXISTS `forms` (
+  `ID` integer PRIMARY KEY AUTOINCREMENT,
+  `ProcessID` integer NOT NULL,
+  `Form` integer NOT NULL UNIQUE,
+  `Archived` tinyint NOT NULL,
+  `Modified` datetime DEFAULT NULL,
+  `Completed` tinyint NOT NULL,
+  `Exported` datetime DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS `forms_process_completed` ON `forms` (`ProcessID`, `Completed`, `Form`);
+
+CREATE TABLE IF NOT EXISTS `files` (
+  `FileID` integer PRIMARY KEY,
+  `Hash` char(64) NOT NULL,
+  `Size` bigint NOT NULL,
+  `FileName` varchar(255) DEFAULT NULL,
+  `Stored` datetime DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS `files_hash` ON `files` (`Hash`);
+
+CREATE TABLE IF NOT EXISTS `groups` (
+  `ID` integer PRIMARY KEY,
+  `Name` varchar(50) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS `jobs` (
+  `Form` integer PRIMARY KEY,
+  `ProcessID` integer NOT NULL,
+  `Fetched` tinyint NOT NULL DEFAULT 0,
+  `JsonSaved` tinyint NOT NULL DEFAULT 0,
+  `Attachments` tinyint NOT NULL DEFAULT 0,
+  `Excel` tinyint NOT NULL DEFAULT 0,
+  `Html` tinyint NOT NULL DEFAULT 0,
+  `Pdf` tinyint NOT NULL DEFAULT 0,
+  `DataPath` varchar(255) DEFAULT NULL,
+  `LeaseOwner` varchar(64) DEFAULT NULL,
+  `LeaseExpires` datetime DEFAULT NULL,
+  `Attempts` integer NOT NULL DEFAULT 0,
+  `Updated` datetime DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS `jobs_process` ON `jobs` (`ProcessID`);
+CREATE INDEX IF NOT EXISTS `jobs_lease_owner` ON `jobs` (`LeaseOwner`);
+
+CREATE TABLE IF NOT EXISTS `processes` (
+  `ProcessID` integer PRIMARY KEY,
+  `Process` varchar(50) NOT NULL,
+  `Enabled` tinyint NOT NULL,
+  `Added` date NOT NULL,
+  `Modified` date NOT NULL,
+  `Forms` integer NOT NULL,
+  `Archived` integer NOT NULL,
+  `Fields` integer NOT NULL,
+  `GroupID` integer NOT NULL,
+  `RepeatingFields` tinyint NOT NULL,
+  `SyncedModified` date DEFAULT NULL,
+  `SyncedForms` integer DEFAULT NULL,
+  `ClaimedBy` varchar(64) DEFAULT NULL,
+  `ClaimExpires` datetime DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS `processes_claimed_by` ON `processes` (`ClaimedBy`);
+
+CREATE TABLE IF NOT EXISTS `schema_version` (
+  `Version` integer PRIMARY KEY,
+  `Applied` datetime NOT NULL
+);
+INSERT OR IGNORE INTO `schema_version` (`Version`, `Applied`) VALUES
+(1, CURRENT_TIMESTAMP),
+(2, CURRENT_TIMESTAMP),
+(3, CURRENT_TIMESTAMP);